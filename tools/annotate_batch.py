@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+@file annotate_batch.py
+@brief Run annotate_streams and annotate_variable on every .json output found under a review directory
+@purpose Re-annotate a whole array (e.g. after a change to the annotation csv format) without running each dataset by hand
+@usage
+review_dir Directory containing check_data output (e.g. the save_dir used by analyze_nc_data.py). Every
+json_output/*.json found under this directory is annotated. Output is saved to the file_analysis folder next to
+the json_output folder, as it is when running analyze_nc_data.py
+user User that completed the review
+processes Number of worker processes. Default: number of cpus
+force Annotate every .json, even if it was already annotated since it was last modified
+@example
+python -m tools.annotate_batch /Users/lgarzio/Documents/OOI/DataReviews/output lgarzio -p 4
+"""
+
+import argparse
+import errno
+import multiprocessing
+import os
+import shutil
+import tempfile
+import traceback
+
+from tools import annotate_streams, annotate_variable
+
+
+def find_datasets(review_dir):
+    # every check_data .json output under the review directory
+    datasets = []
+    for root, dirs, files in os.walk(review_dir):
+        if os.path.basename(root) == 'json_output':
+            datasets.extend(os.path.join(root, f) for f in files if f.endswith('.json'))
+    datasets.sort()
+    return datasets
+
+
+def stamp_file(dataset):
+    # written after a dataset's annotations have been moved into place
+    refdes_dir = os.path.dirname(os.path.dirname(dataset))
+    return os.path.join(refdes_dir, 'file_analysis', '.{}.annotated'.format(os.path.basename(dataset)))
+
+
+def is_current(dataset):
+    stamp = stamp_file(dataset)
+    return os.path.isfile(stamp) and os.path.getmtime(stamp) >= os.path.getmtime(dataset)
+
+
+def move_new(src, dst):
+    """
+    Moves src to dst without overwriting an existing file. If dst exists (e.g. the collocated csv of another dataset
+    of the same refdes, written in the same second), -1, -2... is added to the file name
+    :return: path the file was moved to
+    """
+    stem, ext = os.path.splitext(dst)
+    n = 0
+    while True:
+        target = dst if n == 0 else '{}-{}{}'.format(stem, n, ext)
+        try:
+            os.link(src, target)  # fails if target exists, even if another worker creates it at the same moment
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            n += 1
+            continue
+        os.remove(src)
+        return target
+
+
+def annotate_dataset(args):
+    """
+    Annotates one dataset. The annotation csvs are written to a staging directory and only moved into the
+    file_analysis folder once both tools have finished, so an interrupted run never leaves partial csvs behind.
+    :param args: tuple of (path to .json output, user)
+    :return: tuple of (path to .json output, list of csvs written, error message or None)
+    """
+    dataset, user = args
+    refdes_dir = os.path.dirname(os.path.dirname(dataset))
+    drafts_dir = os.path.join(refdes_dir, 'file_analysis')
+    annotate_streams.make_dir(drafts_dir)
+    staging_dir = tempfile.mkdtemp(prefix='.annotate_', dir=refdes_dir)
+    try:
+        annotate_streams.main(dataset, staging_dir, user)
+        annotate_variable.main(dataset, staging_dir, user)
+
+        written = []
+        staged_dir = os.path.join(staging_dir, 'file_analysis')
+        for f in sorted(os.listdir(staged_dir)):
+            written.append(move_new(os.path.join(staged_dir, f), os.path.join(drafts_dir, f)))
+        with open(stamp_file(dataset), 'w') as stamp:
+            stamp.write('\n'.join(written))
+        return dataset, written, None
+    except Exception:
+        return dataset, [], traceback.format_exc()
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def main(review_dir, user, processes=None, force=False):
+    datasets = find_datasets(review_dir)
+    todo = [x for x in datasets if force or not is_current(x)]
+    print('{} of {} datasets need annotating'.format(len(todo), len(datasets)))
+    if not todo:
+        return []
+
+    pool = multiprocessing.Pool(processes)
+    results = []
+    try:
+        for dataset, written, error in pool.imap_unordered(annotate_dataset, [(x, user) for x in todo]):
+            if error:
+                print('Failed: {}\n{}'.format(dataset, error))
+            else:
+                print('Annotated: {} ({} files)'.format(dataset, len(written)))
+            results.append((dataset, written, error))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Annotate every check_data .json output under a review directory')
+    parser.add_argument('review_dir', help='directory searched recursively for json_output/*.json')
+    parser.add_argument('user', help='user that completed the review')
+    parser.add_argument('-p', '--processes', type=int, default=None, help='number of worker processes')
+    parser.add_argument('-f', '--force', action='store_true', help='annotate datasets that are already up to date')
+    args = parser.parse_args()
+    main(args.review_dir, args.user, args.processes, args.force)
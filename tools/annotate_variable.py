@@ -17,7 +17,9 @@ import os
 from datetime import datetime as dt
 import re
 import pandas as pd
+import numpy as np
 import shutil
+from collections import OrderedDict
 
 
 def make_dir(save_dir):
@@ -40,8 +42,40 @@ def natural_keys(text):
     return [ atoi(c) for c in re.split('(\d+)', text) ]
 
 
-def annotate_variable(data, parameter_csv, parameter_issues_csv, stream_name, review_date, user='root'):
+def coalesce_intervals(intervals, gap_tolerance):
+    '''
+    merges (position, start, end) intervals of consecutive files into spans. position is the index of the file in the
+    sorted file list, so a file that did not trigger the test always ends the span. Next to each other files are
+    merged only if the second starts no more than gap_tolerance after the first ends.
+    returns a list of (span start, span end, number of intervals in the span)
+    '''
+    intervals = sorted(intervals)
+    positions = np.array([i[0] for i in intervals])
+    starts = pd.to_datetime([i[1] for i in intervals]).values
+    ends = pd.to_datetime([i[2] for i in intervals]).values
+
+    new_span = np.ones(len(starts), dtype=bool)
+    new_span[1:] = ((positions[1:] != positions[:-1] + 1) |
+                    (starts[1:] > ends[:-1] + pd.Timedelta(gap_tolerance).to_timedelta64()))
+    first = np.flatnonzero(new_span)
+    counts = np.diff(np.append(first, len(starts)))
+    span_starts = np.minimum.reduceat(starts, first)
+    span_ends = np.maximum.reduceat(ends, first)
+
+    return [(pd.to_datetime(b).strftime('%Y-%m-%dT%H:%M:%SZ'), pd.to_datetime(e).strftime('%Y-%m-%dT%H:%M:%SZ'), c)
+            for b, e, c in zip(span_starts, span_ends, counts)]
 
+
+def annotate_variable(data, parameter_csv, parameter_issues_csv, stream_name, review_date, user='root',
+                      coalesce=True, gap_tolerance='1 day'):
+    '''
+    coalesce: write one row per span of files in which a QC test was triggered, rather than one row per file
+    gap_tolerance: consecutive files that triggered a QC test and are separated by less than this are merged into one
+    span. A file in between that did not trigger the test always ends the span
+    '''
+    qc_tests = [('global_range_test', 'Global Range QC Test'),
+                ('dataqc_spiketest', 'Spike QC Test'),
+                ('dataqc_stuckvaluetest', 'Stuck Value QC Test')]
     format = '%s,%s,%s,%s,%s,%s,%s,%s,%s,%s\n'
     deployment_list = data['deployments']
     deployment_list_sorted = deployment_list.keys()
@@ -62,6 +96,7 @@ def annotate_variable(data, parameter_csv, parameter_issues_csv, stream_name, re
         file_list_sorted.sort(key = natural_keys)  # sorts the files
 
 
+        qc_intervals = OrderedDict()  # (parameter, test) -> file intervals in which the QC test was triggered
         cnt = 0
         for x in file_list_sorted:
             data_begin = data['deployments'][d]['streams'][s]['files'][x]['data_start'] # start date of file
@@ -167,45 +202,36 @@ def annotate_variable(data, parameter_csv, parameter_issues_csv, stream_name, re
                     except KeyError:
                         pass
 
-                    try:
-                        t5 = data['deployments'][d]['streams'][s]['files'][x]['variables'][v]['global_range_test']
-                        if not t5:
-                            pass
-                        else:
-                            newline = (parameter, deployment, data_begin, data_end, 'applies to one file',
-                                       'Global Range QC Test', '', 'check: test triggered', user, review_date)
-                            parameter_issues_csv.write(format % newline)
-                    except KeyError:
-                        pass
-
-                    try:
-                        t6 = data['deployments'][d]['streams'][s]['files'][x]['variables'][v]['dataqc_spiketest']
-                        if not t6:
-                            pass
-                        else:
-                            newline = (parameter, deployment, data_begin, data_end, 'applies to one file',
-                                       'Spike QC Test', '', 'check: test triggered', user, review_date)
-                            parameter_issues_csv.write(format % newline)
-                    except KeyError:
-                        pass
-
-                    try:
-                        t7 = data['deployments'][d]['streams'][s]['files'][x]['variables'][v]['dataqc_stuckvaluetest']
-                        if not t7:
+                    for test, label in qc_tests:
+                        try:
+                            triggered = data['deployments'][d]['streams'][s]['files'][x]['variables'][v][test]
+                        except KeyError:
+                            continue
+                        if not triggered:
                             pass
+                        elif coalesce:  # written once per deployment after all files have been read
+                            qc_intervals.setdefault((parameter, label), []).append((cnt, data_begin, data_end))
                         else:
                             newline = (parameter, deployment, data_begin, data_end, 'applies to one file',
-                                       'Stuck Value QC Test', '', 'check: test triggered', user, review_date)
+                                       label, '', 'check: test triggered', user, review_date)
                             parameter_issues_csv.write(format % newline)
-                    except KeyError:
-                        pass
 
             cnt = cnt + 1
 
+        for (parameter, label), intervals in qc_intervals.items():
+            for span_begin, span_end, count in coalesce_intervals(intervals, gap_tolerance):
+                if count == 1:
+                    notes = 'applies to one file'
+                else:
+                    notes = 'applies to ' + str(count) + ' files'
+                newline = (parameter, deployment, span_begin, span_end, notes, label, '', 'check: test triggered',
+                           user, review_date)
+                parameter_issues_csv.write(format % newline)
+
         deploy_cnt = deploy_cnt + 1
 
 
-def main(dataset, save_dir, user):
+def main(dataset, save_dir, user, coalesce=True, gap_tolerance='1 day'):
     t_now = dt.now().strftime('%Y-%m-%dT%H%M%S')
     review_date = dataset.split('_')[-1].split('.')[0][0:8]
     review_date = dt.strptime(review_date, '%Y%m%d').strftime('%Y-%m-%dT%H:%M:%SZ')
@@ -233,7 +259,8 @@ def main(dataset, save_dir, user):
             writer = csv.writer(parameter_issues_csv)
             writer.writerow(['Level', 'Deployment', 'StartTime', 'EndTime', 'Notes', 'Test', 'Redmine#', 'Todo', 'ReviewedBy', 'ReviewedDate'])
 
-            annotate_variable(data, parameter_csv, parameter_issues_csv, stream_name, review_date, user)
+            annotate_variable(data, parameter_csv, parameter_issues_csv, stream_name, review_date, user, coalesce,
+                              gap_tolerance)
 
     # shutil.copyfile(parameter_file_draft, parameter_file)
 
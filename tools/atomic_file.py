@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+"""
+@file atomic_file.py
+@brief Write a file so that readers only ever see the old or the complete new version
+@purpose The local caches (sensor inventory, dav listings, datateam csvs) are rewritten in place. Writing to a uniquely
+named temporary file in the same directory and renaming it over the target means an interrupted run can't leave a
+truncated cache behind, and two runs writing the same cache at once can't overwrite each other's temporary file
+@example
+from tools.atomic_file import atomic_write
+with atomic_write('/Users/lgarzio/.ooi_sensor_inventory.json') as f:
+    json.dump(inventory, f)
+"""
+
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """
+    :param path: file to write. Replaced only once the with block finishes without an error
+    :param mode: 'w' for text or 'wb' for bytes
+    :return: file object of the temporary file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix='.{}.'.format(os.path.basename(path)), suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.rename(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
@@ -10,6 +10,9 @@ streamed), and uframe_telemetry_status* = status of all valid telemetered and st
 @usage:
 saveDir: location to save output files
 subsites: user-identified subsites to analyze. Must be either a list of subsites (e.g. ['GA01SUMO','GA02HYPM']), or 'all'.
+store_db: optional sqlite file that keeps the endDT and status of every stream from every run (created if it does not
+exist). latency_trends(store_db) summarizes the latency of each stream over time
+watch: poll uFrame every interval seconds and only report the streams whose status changed (needs store_db)
 """
 
 
@@ -17,6 +20,22 @@ import pandas as pd
 import requests
 import os
 import datetime
+import sqlite3
+import sys
+import time
+
+# run from anywhere: make the tools package importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools.atomic_file import atomic_write
+
+# the datateam database csvs are cached here
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ooi_datateam_database')
+
+# status buckets for the time since a stream's last timestamp, in seconds
+STATUS_BINS = [-float('inf'), 3600, 86400, 7 * 86400, 30 * 86400, 365 * 86400, float('inf')]
+STATUS_LABELS = ['<1 hour', '<1 day', '<1 week', '<30 days', '<1 year', '>1 year']
+
+VALID_METHODS = ['streamed','telemetered','recovered-host','recovered-inst','recovered-wfp','recovered-cspp']
 
 
 def define_source(df):
@@ -27,26 +46,53 @@ def define_source(df):
     return df
 
 
-def define_status(sys_endDT, now):
-    sys_endDT_num = datetime.datetime.strptime(sys_endDT[:-1],'%Y-%m-%dT%H:%M:%S.%f')
-    if sys_endDT_num > now - datetime.timedelta(hours=1):
-        status = '<1 hour'
-    elif sys_endDT_num < now - datetime.timedelta(hours=1) and sys_endDT_num > now - datetime.timedelta(days=1):
-        status = '<1 day'
-    elif sys_endDT_num < now - datetime.timedelta(days=1) and sys_endDT_num > now - datetime.timedelta(days=7):
-        status = '<1 week'
-    elif sys_endDT_num < now - datetime.timedelta(days=7) and sys_endDT_num > now - datetime.timedelta(days=30):
-        status = '<30 days'
-    elif sys_endDT_num < now - datetime.timedelta(days=30) and sys_endDT_num > now - datetime.timedelta(days=365):
-        status = '<1 year'
-    else:
-        status = '>1 year'
-    return status
+def define_status(endDT, now):
+    """
+    Buckets the time since each stream's last timestamp
+    :param endDT: series of uFrame end timestamps, e.g. '2017-12-12T15:00:00.000Z'
+    :param now: datetime the status is relative to
+    :return: series of status labels, e.g. '<1 day'
+    """
+    end = pd.to_datetime(endDT.str.rstrip('Z'), format='%Y-%m-%dT%H:%M:%S.%f', errors='coerce')
+    age = (now - end).dt.total_seconds()
+    return pd.cut(age, STATUS_BINS, right=False, labels=STATUS_LABELS).astype(object)
+
+
+def cached_csv(url, cache_dir=CACHE_DIR):
+    """
+    Reads a csv from GitHub through a local copy. The local copy is revalidated with the ETag GitHub sent with it, and
+    is used as is when GitHub can't be reached
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    fname = os.path.join(cache_dir, os.path.basename(url))
+    etag_file = fname + '.etag'
+    cached = os.path.isfile(fname)
+    headers = {}
+    if cached and os.path.isfile(etag_file):
+        with open(etag_file, 'r') as f:
+            headers['If-None-Match'] = f.read().strip()
+
+    try:
+        r = requests.get(url, headers=headers, timeout=30)
+        r.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        if not cached:
+            raise
+        print('Could not refresh {} ({}), using the local copy'.format(url, e))
+        return pd.read_csv(fname)
+
+    if r.status_code != 304:
+        with atomic_write(fname, 'wb') as f:
+            f.write(r.content)
+        with open(etag_file, 'w') as f:
+            f.write(r.headers.get('ETag', ''))
+    return pd.read_csv(fname)
 
 
 def get_database():
-    db_inst_stream = pd.read_csv('https://raw.githubusercontent.com/seagrinch/data-team-python/master/infrastructure/data_streams.csv')
-    db_stream_desc = pd.read_csv('https://raw.githubusercontent.com/seagrinch/data-team-python/master/infrastructure/stream_descriptions.csv')
+    db_inst_stream = cached_csv('https://raw.githubusercontent.com/seagrinch/data-team-python/master/infrastructure/data_streams.csv')
+    db_stream_desc = cached_csv('https://raw.githubusercontent.com/seagrinch/data-team-python/master/infrastructure/stream_descriptions.csv')
 
     db_inst_stream = db_inst_stream[['reference_designator','method','stream_name']]
     db_stream_desc = db_stream_desc.rename(columns={'name':'stream_name'})
@@ -59,28 +105,122 @@ def get_database():
 
 def get_uframe_data(valid_methods, now):
     x = requests.get('https://ooinet.oceanobservatories.org/api/uframe/stream')
-    stream_info = x.json()
-    sys_list = []
-    for i in range(len(stream_info['streams'])):
-        sys_method = stream_info['streams'][i]['stream_method']
-        if sys_method in valid_methods:
-            sys_refdes = stream_info['streams'][i]['reference_designator']
-            sys_stream = stream_info['streams'][i]['stream']
-            sys_endDT = stream_info['streams'][i]['end']
-            sys_method_rp = sys_method.replace('-','_')
-            status = define_status(sys_endDT, now)
-            source = 'uframe'
-            sys_list.append([sys_refdes,sys_method_rp,sys_stream,sys_endDT,status,source])
-    return sys_list
-
-
-def main(saveDir, subsites):
-    now = datetime.datetime.utcnow()
+    streams = pd.DataFrame(x.json()['streams'], columns=['reference_designator', 'stream_method', 'stream', 'end'])
+    streams = streams[streams['stream_method'].isin(valid_methods)]
+    uframe_df = pd.DataFrame({'reference_designator': streams['reference_designator'],
+                              'method': streams['stream_method'].str.replace('-', '_'),
+                              'stream_name': streams['stream'],
+                              'endDT': streams['end']})
+    uframe_df['status'] = define_status(uframe_df['endDT'], now)
+    uframe_df['source'] = 'uframe'
+    return uframe_df[['reference_designator','method','stream_name','endDT','status','source']]
+
+
+def connect_store(store_db):
+    # streams are stored once and referred to by id, so each snapshot row is four numbers and a short label
+    con = sqlite3.connect(store_db)
+    con.execute('CREATE TABLE IF NOT EXISTS streams (id INTEGER PRIMARY KEY, reference_designator TEXT, method TEXT, '
+                'stream_name TEXT, UNIQUE (reference_designator, method, stream_name))')
+    con.execute('CREATE TABLE IF NOT EXISTS snapshots (stream_id INTEGER, taken INTEGER, endDT INTEGER, status TEXT)')
+    con.execute('CREATE INDEX IF NOT EXISTS snapshots_stream ON snapshots (stream_id, taken)')
+    con.execute('CREATE TABLE IF NOT EXISTS current (stream_id INTEGER PRIMARY KEY, taken INTEGER, endDT INTEGER, '
+                'status TEXT)')
+    return con
+
+
+def record_snapshot(store_db, uframe_df, now):
+    """
+    Appends the endDT and status of every stream to the store
+    :param uframe_df: dataframe from get_uframe_data
+    :return: dataframe of the streams whose status changed since the previous snapshot (or that are new), with the
+    previous status in previous_status
+    """
+    keys = ['reference_designator', 'method', 'stream_name']
+    df = uframe_df[keys + ['endDT', 'status']].copy()
+    df['endDT'] = pd.to_datetime(df['endDT'].str.rstrip('Z'), format='%Y-%m-%dT%H:%M:%S.%f', errors='coerce')
+    df = df[df['endDT'].notnull()]
+    taken = int((now - datetime.datetime(1970, 1, 1)).total_seconds())
+
+    con = connect_store(store_db)
+    with con:
+        con.executemany('INSERT OR IGNORE INTO streams (reference_designator, method, stream_name) VALUES (?,?,?)',
+                        df[keys].values.tolist())
+        ids = pd.read_sql_query('SELECT id AS stream_id, reference_designator, method, stream_name FROM streams', con)
+        df = pd.merge(df, ids, on=keys, how='left')
+        df['endDT'] = df['endDT'].astype('int64') // 10 ** 9
+        df['taken'] = taken
 
-    valid_methods = ['streamed','telemetered','recovered-host','recovered-inst','recovered-wfp','recovered-cspp']
+        previous = pd.read_sql_query('SELECT stream_id, status AS previous_status FROM current', con)
+        df = pd.merge(df, previous, on='stream_id', how='left')
 
-    sys_list = get_uframe_data(valid_methods, now)
-    uframe_df = pd.DataFrame(sys_list,columns=['reference_designator','method','stream_name','endDT','status','source'])
+        rows = df[['stream_id', 'taken', 'endDT', 'status']].values.tolist()
+        con.executemany('INSERT INTO snapshots (stream_id, taken, endDT, status) VALUES (?,?,?,?)', rows)
+        con.executemany('INSERT OR REPLACE INTO current (stream_id, taken, endDT, status) VALUES (?,?,?,?)', rows)
+    con.close()
+
+    changed = df[df['status'] != df['previous_status']]
+    return changed[keys + ['previous_status', 'status']].reset_index(drop=True)
+
+
+def latency_trends(store_db, days=30):
+    """
+    Latency (time between a snapshot and the stream's last timestamp) of every stream over the last `days` days
+    :return: dataframe with the snapshots, latest, mean and max latency in hours, and the trend in hours of latency per
+    day (least squares slope). A stream that has stopped delivering data has a trend of about 24 hours per day
+    """
+    con = connect_store(store_db)
+    df = pd.read_sql_query('SELECT s.reference_designator, s.method, s.stream_name, n.taken, n.endDT FROM snapshots n '
+                           'JOIN streams s ON s.id = n.stream_id WHERE n.taken >= (SELECT MAX(taken) FROM snapshots) - ?',
+                           con, params=(days * 86400,))
+    con.close()
+
+    keys = ['reference_designator', 'method', 'stream_name']
+    df['latency'] = (df['taken'] - df['endDT']) / 3600.
+    df['day'] = (df['taken'] - df['taken'].min()) / 86400.  # offset keeps the sums of squares small
+    df['day_latency'] = df['day'] * df['latency']
+    df['day2'] = df['day'] ** 2
+    g = df.sort_values('taken').groupby(keys)
+    trends = g.agg({'taken': 'count', 'latency': ['last', 'mean', 'max'], 'day': 'sum', 'day_latency': 'sum',
+                    'day2': 'sum'})
+    trends.columns = ['_'.join(x) for x in trends.columns]
+    n = trends['taken_count']
+    sum_lat = trends['latency_mean'] * n
+    denominator = n * trends['day2_sum'] - trends['day_sum'] ** 2
+    trends['trend'] = (n * trends['day_latency_sum'] - trends['day_sum'] * sum_lat) / denominator.where(denominator > 0)
+    trends = trends.rename(columns={'taken_count': 'snapshots', 'latency_last': 'latency', 'latency_mean': 'mean_latency',
+                                    'latency_max': 'max_latency'})
+    return trends[['snapshots', 'latency', 'mean_latency', 'max_latency', 'trend']].reset_index()
+
+
+def filter_subsites(df, subsites):
+    if subsites == 'all':
+        return df
+    return df[df.reference_designator.str.split('-').str[0].isin(subsites)]
+
+
+def watch(saveDir, subsites, store_db, interval=3600):
+    """
+    Polls uFrame every `interval` seconds, records each snapshot in the store, and prints and appends to
+    uframe_status_changes.csv only the streams whose status changed. Stop with Ctrl-C
+    """
+    fname = os.path.join(saveDir, 'uframe_status_changes.csv')
+    while True:
+        now = datetime.datetime.utcnow()
+        uframe_df = filter_subsites(get_uframe_data(VALID_METHODS, now), subsites)
+        changed = record_snapshot(store_db, uframe_df, now)
+        if not changed.empty:
+            changed.insert(0, 'time', now.strftime('%Y-%m-%dT%H:%M:%S'))
+            print(changed)
+            changed.to_csv(fname, mode='a', index=False, header=not os.path.isfile(fname))
+        time.sleep(interval)
+
+
+def main(saveDir, subsites, store_db=None):
+    now = datetime.datetime.utcnow()
+
+    uframe_df = get_uframe_data(VALID_METHODS, now)
+    if store_db:
+        record_snapshot(store_db, filter_subsites(uframe_df, subsites), now)
     db = get_database()
 
     df = pd.merge(db,uframe_df,on=['reference_designator','method','stream_name'],how='outer')
@@ -109,4 +249,10 @@ if __name__ == '__main__':
     saveDir = '/Users/lgarzio/Documents/OOI/uframe_status_reports/'
     #subsites = 'all'
     subsites = ['GA01SUMO','GA02HYPM']
-    main(saveDir, subsites)
\ No newline at end of file
+    store_db = os.path.join(saveDir, 'uframe_status.db')
+    watch_mode = False
+    interval = 3600
+    if watch_mode:
+        watch(saveDir, subsites, store_db, interval)
+    else:
+        main(saveDir, subsites, store_db)
\ No newline at end of file
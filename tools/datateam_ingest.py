@@ -2,22 +2,70 @@
 """
 @author Mike Smith
 @email michaesm@marine.rutgers.edu
-change username, api_key, api_token, and csv_path (lines 242 - 265)
+@brief Create ingestion requests in uFrame from the ingestion csvs (https://github.com/ooi-integration/ingestion-csvs),
+optionally cancelling/suspending recurring ingestions and purging the reference designators first
+@usage
+Interactive: change username, api_key, api_token, and csv_path (bottom of this file) and run
+    python -m tools.datateam_ingest
+Unattended: python -m tools.datateam_ingest --plan plan.yml
+
+The plan is a YAML (or JSON) file:
+    base_url: https://ooinet.oceanobservatories.org
+    username: michaesm
+    api_key: username             # or set OOINET_API_KEY
+    api_token: token              # or set OOINET_API_TOKEN
+    csv_path: /local_path_to_ingestion-csvs/
+    type: recovered               # recovered or telemetered
+    priority: 1                   # 0=highest to 10=lowest
+    arrays: [CE, GA]
+    platforms: [CE01ISSM]         # optional. Default: every platform in the arrays
+    deployments: [1, 2]           # optional. Default: every deployment
+    csv_types: [R, D]             # optional. Default: D for telemetered, R and D for recovered
+    begin_file_date: 2017-01-01   # optional. Exclude files modified before this date (telemetered)
+    end_file_date: 2017-06-01     # optional. Exclude files modified after this date (recovered)
+    recurring: persist            # persist, cancel or suspend recurring (TELEMETERED/RUN) ingestions of the refdes
+    purge: false                  # purge the reference designators before ingesting
+    save_dir: .                   # where the _purged and _ingested csvs are written
+    workers: 8                    # number of ingest requests submitted at once
+    monitor: false                # follow the submitted requests until they finish (recovered)
+
+Follow ingest requests that are already running: python -m tools.datateam_ingest --monitor 1234 1235
+(credentials from OOINET_API_KEY and OOINET_API_TOKEN)
 """
 
+import argparse
 import requests
 import pandas as pd
 import os
-import glob
 import re
-import urllib2
-import pickle
 import datetime as dt
-import netCDF4 as nc
-from pandas.io.json import json_normalize
+import time
+import numpy as np
+import yaml
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from tools import ingest_catalog
+from tools.m2m_get_annotations import not_sent
 
 HTTP_STATUS_OK = 200
 
+# Avoid these platforms right now
+cabled = ['RS', 'CE02SHBP', 'CE02SHSP', 'CE04OSBP', 'CE04OSPD', 'CE04OSPS']
+cabled_reg_ex = re.compile('|'.join(cabled))
+
+# The CTDMO decoder is invoked for these reference designators
+wcard_refdes = ['GA03FLMA-RIM01-02-CTDMOG000','GA03FLMB-RIM01-02-CTDMOG000',
+                'GI03FLMA-RIM01-02-CTDMOG000','GI03FLMB-RIM01-02-CTDMOG000',
+                'GP03FLMA-RIM01-02-CTDMOG000','GP03FLMB-RIM01-02-CTDMOG000',
+                'GS03FLMA-RIM01-02-CTDMOG000','GS03FLMB-RIM01-02-CTDMOG000']
+
+# jobcounts file statuses that have not been processed yet
+ACTIVE_FILE_STATUSES = ('PENDING', 'QUEUED', 'RUNNING')
+
+# initialize requests session
+session = requests.session()
+
 
 def file_date():
     date_cutoff = raw_input('Please enter file cutoff date in the form (yyyy-mm-dd): ')
@@ -25,7 +73,7 @@ def file_date():
 
     if date_cutoff:
         if r.match(date_cutoff) is None:
-            print 'Incorrect date format entered.'
+            print('Incorrect date format entered.')
             date_cutoff = file_date()
     else:
         'No date entered.'
@@ -33,80 +81,144 @@ def file_date():
     return date_cutoff
 
 
-def csv_select(csvs, serve):
+def csv_select(csvs, serve, username, priority):
     df = pd.DataFrame()
     recovered = [x for x in csvs if 'R000' in x]
     telemetered = [x for x in csvs if 'D000' in x]
     telemetered.sort(reverse=True)
     csvs = telemetered + recovered
     if 'telemetered' in serve:
-        print 'Please select csv(s) for active telemetered ingestion. Latest telemetered deployment CSV listed first'
+        print('Please select csv(s) for active telemetered ingestion. Latest telemetered deployment CSV listed first')
         for csv in telemetered:
             yes = raw_input('Ingest {}? y/<n>: '.format(csv)) or 'n'
             if 'y' in yes:
-                t_df = load_ingestion_sheet(csv)
-                t_df['username'] = username
-                t_df['deployment'] = get_deployment_number(csv)
-                t_df['type'] = 'TELEMETERED'
-                t_df['state'] = 'RUN'
-                t_df['priority'] = priority
                 begin = raw_input('Set a beginning file date to exclude any files modified before this date? y/<n>') or 'n'
-                if 'y' in begin:
-                    t_df['beginFileDate'] = file_date()
+                begin_date = file_date() if 'y' in begin else None
+                t_df = load_csv_request(csv, username, 'TELEMETERED', priority, begin_file_date=begin_date)
                 df = df.append(t_df, ignore_index=True)
             else:
                 continue
     else:
-        print 'Please select csv(s) for recovered ingestion.'
+        print('Please select csv(s) for recovered ingestion.')
         for csv in csvs:
             yes = raw_input('Ingest {}? <y>/n: '.format(csv)) or 'y'
             if 'y' in yes:
-                t_df = load_ingestion_sheet(csv)
-                t_df['username'] = username
-                t_df['deployment'] = get_deployment_number(csv)
-                t_df['type'] = 'RECOVERED'
-                t_df['state'] = 'RUN'
-                t_df['priority'] = priority
                 end = raw_input('Set an ending file date to exclude files modified after this date? y/<n>') or 'n'
-                if 'y' in end:
-                    end_date = file_date()
-                    t_df['endFileDate'] = end_date
+                end_date = file_date() if 'y' in end else None
+                t_df = load_csv_request(csv, username, 'RECOVERED', priority, end_file_date=end_date)
                 df = df.append(t_df, ignore_index=True)
             else:
                 continue
 
     if df.empty:
         print('At least one csv must be selected. Please select csv')
-        df = csv_select(csvs, serve)
+        df = csv_select(csvs, serve, username, priority)
+    return df
+
+
+def plan_select(csvs, plan):
+    # non-interactive version of csv_select, driven by the plan
+    serve = plan.get('type', 'recovered').lower()
+    csv_types = plan.get('csv_types', ['D'] if 'telemetered' in serve else ['R', 'D'])
+    deployments = plan.get('deployments')
+
+    df = pd.DataFrame()
+    for csv in csvs:
+        if not any('{}000'.format(t.upper()) in csv for t in csv_types):
+            continue
+        if deployments and get_deployment_number(csv) not in deployments:
+            continue
+        if 'telemetered' in serve:
+            t_df = load_csv_request(csv, plan['username'], 'TELEMETERED', plan.get('priority', 1),
+                                    begin_file_date=plan.get('begin_file_date'))
+        else:
+            t_df = load_csv_request(csv, plan['username'], 'RECOVERED', plan.get('priority', 1),
+                                    end_file_date=plan.get('end_file_date'))
+        print('Selected {}'.format(csv))
+        df = df.append(t_df, ignore_index=True)
     return df
 
 
-def change_recurring_ingestion(api_key, api_token, recurring):
-    state_change = pd.DataFrame()
+def load_csv_request(csv, username, ingest_type, priority, begin_file_date=None, end_file_date=None):
+    # load an ingestion csv with the request information added to every row
+    t_df = load_ingestion_sheet(csv)
+    t_df['username'] = username
+    t_df['deployment'] = get_deployment_number(csv)
+    t_df['type'] = ingest_type
+    t_df['state'] = 'RUN'
+    t_df['priority'] = priority
+    if begin_file_date:
+        t_df['beginFileDate'] = str(begin_file_date)
+    if end_file_date:
+        t_df['endFileDate'] = str(end_file_date)
+    return t_df
+
 
+def change_recurring_ingestion(base_url, api_key, api_token, recurring):
+    # ask which recurring ingestions should be cancelled or suspended
     if not recurring.empty:
         print('Recurring ingestions found for these reference designators.')
         print(recurring)
         state = raw_input('Would you like to persist, cancel, suspend any of these ingestions? <persist>/cancel/suspend: ') or 'persist'
         if state in ('cancel', 'suspend'):
-            # for i in recurring.iter():
             which = raw_input('Please list ingestion id (comma separated) that you would like to {}: '.format(state))
             if which:
                 ids_to_purge = map(int, which.split(','))
-                if ids_to_purge:
-                    for i in ids_to_purge:
-                        r = change_ingest_state(base_url, api_key, api_token, i, state.upper())
-                        if r.status_code == HTTP_STATUS_OK:
-                            state_json = r.json()
-                        else:
-                            print('Status Code: {}, Response: {}'.format(r.status_code, r.content))
-                            continue
-                        tdf = pd.DataFrame([state_json], columns=state_json.keys())
-                        state_change = state_change.append(tdf, ignore_index=True)
-                    print(state_change)
+                return change_states(base_url, api_key, api_token, ids_to_purge, state)
+    return pd.DataFrame()
+
+
+def change_state(base_url, api_key, api_token, ingest_id, state, attempts=5, wait=2):
+    """
+    Cancel or suspend one ingestion request and wait until uFrame reports the new state
+    :return: dictionary with the request as returned by uFrame, and whether the change was confirmed
+    """
+    try:
+        r = change_ingest_state(base_url, api_key, api_token, ingest_id, state)
+        if r is None:
+            return dict(id=ingest_id, confirmed=False, error='state change rejected')
+        for attempt in range(attempts):
+            check = check_ingest_request(base_url, api_key, api_token, ingest_id)
+            if check is not None and check.json().get('state') == state:
+                info = check.json()
+                info['confirmed'] = True
+                return info
+            time.sleep(wait)
+    except requests.exceptions.RequestException as e:
+        return dict(id=ingest_id, confirmed=False, error=str(e))
+    return dict(id=ingest_id, confirmed=False, error='state is not {} after {} checks'.format(state, attempts))
+
+
+def change_states(base_url, api_key, api_token, ingest_ids, state, workers=8):
+    # cancel or suspend all of the ingestion requests at once, confirming that each change took effect
+    ingest_ids = list(ingest_ids)
+    results = []
+    pool = ThreadPool(workers)
+    try:
+        jobs = pool.imap_unordered(lambda i: change_state(base_url, api_key, api_token, i, state.upper()), ingest_ids)
+        for n, info in enumerate(jobs, 1):
+            if not info['confirmed']:
+                print('Could not change the state of ingest request {}: {}'.format(info['id'], info['error']))
+            print('[{}/{}] ingest request {} {}'.format(n, len(ingest_ids), info['id'],
+                                                        state.upper() if info['confirmed'] else 'FAILED'))
+            results.append(info)
+    finally:
+        pool.close()
+        pool.join()
+
+    state_change = pd.DataFrame(results)
+    print(state_change)
     return state_change
 
 
+def still_running(recurring, state_change):
+    # reference designators whose recurring ingestions could not be cancelled/suspended, and so must not be purged
+    if state_change.empty:
+        return set()
+    failed = state_change.loc[~state_change['confirmed'].astype(bool), 'id']
+    return set(recurring.loc[recurring['ingest_id'].isin(failed), 'refDes'])
+
+
 def get_active_ingestions(base_url, api_key, api_token):
     r = session.get('{}/api/m2m/12589/ingestrequest/jobcounts?active=true&groupBy=refDes,status'.format(base_url),
                      auth=(api_key, api_token))
@@ -145,7 +257,7 @@ def build_ingest_dict(ingest_info):
                         priority=ingest_info['priority'])
 
     for k in ['beginFileDate', 'endFileDate']:
-        if k in keys:
+        if k in keys and pd.notnull(ingest_info[k]):
             option_dict[k] = ingest_info[k]
 
     if option_dict:
@@ -154,16 +266,6 @@ def build_ingest_dict(ingest_info):
     return request_dict
 
 
-def ingest_data(base_url, api_key, api_token, data_dict):
-    r = session.post('{}/api/m2m/12589/ingestrequest'.format(base_url),
-                      json=data_dict,
-                      auth=(api_key, api_token))
-    if r.ok:
-        return r
-    else:
-        pass
-
-
 def change_ingest_state(base_url, api_key, api_token, ingest_id, state):
     r = session.put('{}/api/m2m/12589/ingestrequest/{}'.format(base_url, ingest_id),
                      json=dict(id=ingest_id, state=state),
@@ -202,197 +304,449 @@ def purge_data(base_url, api_key, api_token, ref_des_dict):
         pass
 
 
-def uframe_routes():
-    """
-    This function loads a pickle file containing all uframe_routes to their proper drivers
-    :return: dictionary containing the uframe_routes to driver
-    :rtype: dictionary
-    """
-    fopen = urllib2.urlopen('https://raw.githubusercontent.com/ooi-data-review/parse_spring_files/master/uframe_routes.pkl')
-    ingest_dict = pickle.load(fopen)
-    return ingest_dict
-
-
 def load_ingestion_sheet(csv):
-    t_df = pd.read_csv(csv, usecols=[0, 1, 2, 3])
-    return t_df
+    t_df = ingest_catalog.read_csv(csv)
+    return t_df.iloc[:, :4]
 
 
 def get_deployment_number(csv):
-    split_csv = csv.split('_')
+    split_csv = os.path.basename(csv).split('_')
     deployment_number = int(re.sub('.*?([0-9]*)$', r'\1', split_csv[1]))
     return deployment_number
 
-desired_width = 320
-pd.set_option('display.width', desired_width)
 
-# initialize requests session
-global session
-session = requests.session()
+def find_platforms(csv_path, arrays):
+    # platforms in the selected arrays that have ingestion csvs
+    return [x for x in ingest_catalog.find_platforms(csv_path, arrays) if not cabled_reg_ex.search(x)]
 
-# Load uframe_routes from github.
-ingest_dict = uframe_routes()
 
-# Initialize empty Pandas DataFrames
-purge_df = pd.DataFrame()
-ingest_df = pd.DataFrame()
-recurring = pd.DataFrame()
+def find_csvs(csv_path, platforms):
+    return ingest_catalog.find_csvs(csv_path, platforms)
 
-# OOINET authorization information and base_url
-username = 'michaesm'
 
-# ooinet production
-base_url = 'https://ooinet.oceanobservatories.org'
-api_key = 'username'
-api_token = 'token'
+def prepare_requests(df):
+    df = df.sort_values(['deployment', 'reference_designator'])
+    df = df.rename(columns={'filename_mask': 'fileMask', 'reference_designator': 'refDes', 'data_source': 'dataSource',
+                            'parser': 'parserDriver'})
+    df = df[pd.notnull(df['fileMask'])]
+    return df
 
-# ooinet-dev-01
-# base_url = 'https://ooinet-dev-01.oceanobservatories.org'
-# api_key = 'username'
-# api_token = 'token'
 
-# ooinet-dev-03
-# base_url = 'https://ooinet-dev-03.oceanobservatories.org'
-# api_key = 'username'
-# api_token = 'token'
+def get_telemetered_requests(base_url, api_key, api_token):
+    # Get ingestion requests with ID so that we can check if we are ingesting data that already has a recurring ingestion
+    all_ingest = get_all_ingest_requests(base_url, api_key, api_token)
+    all_ingest = all_ingest.json()
+
+    # one row per file mask of the recurring (TELEMETERED/RUN) requests. The request's status and id are renamed because
+    # the file masks have keys with the same names
+    rows = []
+    for l in all_ingest:
+        if l['state'] != 'RUN' or l['type'] != 'TELEMETERED':
+            continue
+        info = dict(username=l['username'], type=l['type'], ingest_status=l['status'], ingest_id=l['id'],
+                    state=l['state'], priority=l['priority'], entryDate=l['entryDate'], modifiedDate=l['modifiedDate'])
+        for mask in l['ingestRequestFileMasks']:
+            row = dict(mask)
+            rd = row.pop('refDes')
+            row['refDes'] = '-'.join([rd['subsite'], rd['node'], rd['sensor']])
+            row.update(info)
+            rows.append(row)
+
+    df_telemetered = pd.DataFrame(rows)
+    if df_telemetered.empty:
+        return pd.DataFrame(columns=['refDes', 'fileMask', 'ingest_id', 'changed_status', 'purged'])
+    for k in ['entryDate', 'modifiedDate']:
+        df_telemetered[k + 'Str'] = pd.to_datetime(df_telemetered.pop(k), unit='ms').dt.strftime('%Y-%m-%d %H:%M:%S')
+    df_telemetered['changed_status'] = None
+    df_telemetered['purged'] = None
+    return df_telemetered
+
+
+def find_recurring(df_telemetered, df):
+    """
+    Recurring ingestions that conflict with the planned requests, either because they ingest one of the planned
+    reference designators or because they use exactly the same file mask as a planned request
+    :param df_telemetered: recurring requests from get_telemetered_requests
+    :param df: planned requests from prepare_requests
+    :return: the conflicting recurring requests, with refDes_overlap and fileMask_overlap flags
+    """
+    print('\nUnique Reference Designators in these ingestion CSV files')
+    for rd in sorted(pd.unique(df['refDes'])):
+        print(rd)
+
+    refdes_overlap = df_telemetered['refDes'].isin(df['refDes'].unique())
+    mask_overlap = df_telemetered['fileMask'].isin(df['fileMask'].unique())
+    recurring = df_telemetered[refdes_overlap | mask_overlap].copy()
+    recurring['refDes_overlap'] = refdes_overlap[recurring.index]
+    recurring['fileMask_overlap'] = mask_overlap[recurring.index]
+    return recurring.reset_index(drop=True)
+
+
+def purge_refdes(base_url, api_key, api_token, rd):
+    split = rd.split('-')
+    ref_des = dict(subsite=split[0], node=split[1], sensor='{}-{}'.format(split[2], split[3]))
+    try:
+        purge_info = purge_data(base_url, api_key, api_token, ref_des)
+    except requests.exceptions.RequestException as e:
+        return dict(ReferenceDesignator=rd, error=str(e))
+    if purge_info is None:
+        return dict(ReferenceDesignator=rd, error='purge rejected')
+    info = purge_info.json()
+    info['ReferenceDesignator'] = rd
+    return info
+
+
+def purge(base_url, api_key, api_token, unique_ref_des, workers=8):
+    # purge all of the reference designators at once
+    results = []
+    pool = ThreadPool(workers)
+    try:
+        jobs = pool.imap_unordered(lambda rd: purge_refdes(base_url, api_key, api_token, rd), unique_ref_des)
+        for n, info in enumerate(jobs, 1):
+            print('[{}/{}] purge {} {}'.format(n, len(unique_ref_des), info['ReferenceDesignator'],
+                                               'FAILED: {}'.format(info['error']) if 'error' in info else 'done'))
+            results.append(info)
+    finally:
+        pool.close()
+        pool.join()
+
+    purge_df = pd.DataFrame(results)
+    failed = sum('error' in x for x in results)
+    print('Purge Completed{}'.format(' ({} failed)'.format(failed) if failed else ''))
+    print(purge_df)
+    return purge_df
 
-# ooinet-dev-04
-# base_url = 'https://ooinet-dev-04.oceanobservatories.org'
-# api_key = 'username'
-# api_token = 'token'
 
-priority = 1
-csv_path = '/local_path_to_ingestion-csvs/'
+def submit_request(base_url, api_key, api_token, data_dict, retries=3, backoff=2):
+    """
+    POST one ingest request. Only retried when uFrame can't have created the request (the connection could not be
+    opened, or the request was rejected with 429 or 503), so a retry never creates a duplicate ingestion. A connection
+    that drops after the request was sent is not retried, since uFrame may already have queued the ingestion
+    :return: tuple of (response or None, error message or None, seconds taken by the last attempt)
+    """
+    for attempt in range(retries + 1):
+        start = time.time()
+        try:
+            r = session.post('{}/api/m2m/12589/ingestrequest'.format(base_url), json=data_dict,
+                             auth=(api_key, api_token))
+        except requests.exceptions.ConnectionError as e:
+            latency = time.time() - start
+            if attempt == retries or not not_sent(e):
+                return None, str(e), latency
+        except requests.exceptions.Timeout as e:
+            return None, str(e), time.time() - start
+        else:
+            latency = time.time() - start
+            if r.ok:
+                return r, None, latency
+            if r.status_code not in (429, 503) or attempt == retries:
+                return r, 'Status Code: {}, Response: {}'.format(r.status_code, r.content), latency
+        time.sleep(backoff * 2 ** attempt)
 
 
-# Avoid these platforms right now
-cabled = ['RS', 'CE02SHBP', 'CE02SHSP', 'CE04OSBP', 'CE04OSPD', 'CE04OSPS']
-cabled_reg_ex = re.compile('|'.join(cabled))
+def submit_ingestions(base_url, api_key, api_token, df, workers=8):
+    """
+    Submit one ingest request per row with a parser, with up to `workers` requests in flight
+    :return: dataframe with the uFrame response for each request
+    """
+    df = df.copy()
+    parsers = df['parserDriver'].fillna('')
+    df = df[(parsers != '') & ~parsers.str.contains('#')]
+    # the CTDMO decoder will be invoked for refDesFinal = 'false' and will not be invoked for 'true'
+    df['refDesFinal'] = np.where(df['refDes'].isin(wcard_refdes), 'false', 'true')
+    rows = df.to_dict('records')
+
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers))
+
+    def submit(row):
+        r, error, latency = submit_request(base_url, api_key, api_token, build_ingest_dict(row))
+        if error is None:
+            try:
+                result = r.json()
+            except ValueError:  # e.g. an html page from a proxy. The request may still have been created
+                result = dict(error=r.text)
+        else:
+            result = dict(error=error)
+        result['latency'] = latency
+        for k in ['refDes', 'state', 'type', 'deployment', 'username', 'priority', 'refDesFinal', 'fileMask']:
+            result['ReferenceDesignator' if k == 'refDes' else k] = row[k]
+        return result
+
+    start = time.time()
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(submit, rows)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+
+    ingest_df = pd.DataFrame(results)
+    if results:
+        failed = sum('error' in x for x in results)
+        print('{} ingest requests submitted ({} failed) in {:.1f} s: {:.1f} requests/s, p95 latency {:.2f} s'.format(
+            len(results), failed, elapsed, len(results) / elapsed, np.percentile(ingest_df['latency'], 95)))
+    print(ingest_df)
+    return ingest_df
+
+
+def save_results(purge_df, ingest_df, save_dir='.'):
+    utc_time = dt.datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+    purge_df.to_csv(os.path.join(save_dir, '{}_purged.csv'.format(utc_time)), index=False)
+    ingest_df.to_csv(os.path.join(save_dir, '{}_ingested.csv'.format(utc_time)), index=False)
+
+
+def file_counts(base_url, api_key, api_token, ingest_id):
+    # {status: number of files} for an ingest request, or None if uFrame could not be reached or sent a bad response
+    try:
+        r = check_ingest_file_status(base_url, api_key, api_token, ingest_id)
+        if r is None:
+            return None
+        counts = r.json()
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+    if not isinstance(counts, dict):
+        return None
+    if str(ingest_id) in counts:  # grouped under the request id
+        counts = counts[str(ingest_id)]
+        if not isinstance(counts, dict):
+            return None
+    return dict((k, v) for k, v in counts.items() if isinstance(v, int))
+
+
+def status_table(jobs):
+    now = time.time()
+    rows = []
+    for j in jobs.values():
+        elapsed = ((j['completed'] or now) - j['started']) / 60.
+        row = dict(ingest_id=j['ingest_id'], stale=j['stale'], files=j['files'], files_done=j['done'],
+                   started=dt.datetime.utcfromtimestamp(j['started']).strftime('%Y-%m-%d %H:%M:%S'),
+                   completed=dt.datetime.utcfromtimestamp(j['completed']).strftime('%Y-%m-%d %H:%M:%S')
+                   if j['completed'] else '',
+                   minutes=round(elapsed, 1), files_per_min=round(j['done'] / elapsed, 1) if elapsed else 0.)
+        row.update(j['counts'])
+        rows.append(row)
+    columns = ['ingest_id', 'stale', 'files', 'files_done', 'started', 'completed', 'minutes', 'files_per_min']
+    table = pd.DataFrame(rows)
+    return table[columns + sorted(set(table.columns) - set(columns))].fillna(0)
+
+
+def monitor_ingestions(base_url, api_key, api_token, ingest_ids, save_file, workers=8, min_interval=30,
+                       max_interval=600, max_age=43200):
+    """
+    Follow ingest requests until every file of each request has been processed. Requests that are due are polled
+    together on the jobcounts endpoint. A request's polling interval doubles (up to max_interval seconds) each time its
+    counts have not changed, and drops back to min_interval when they do. The status table is printed and written to
+    save_file after every round. A request whose counts have not changed (or never appeared) for max_age seconds is
+    marked stale and no longer polled. Recurring (telemetered) requests never finish, so only follow recovered requests.
+    :return: dataframe with the file counts, completion time and files per minute of each request
+    """
+    now = time.time()
+    jobs = OrderedDict((i, dict(ingest_id=i, started=now, changed=now, next_poll=now, interval=min_interval, counts={},
+                                files=0, done=0, completed=None, stale=False)) for i in ingest_ids)
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers))
+
+    def poll(job):
+        return file_counts(base_url, api_key, api_token, job['ingest_id'])
+
+    pool = ThreadPool(workers)
+    try:
+        while True:
+            due = [j for j in jobs.values() if j['completed'] is None and not j['stale'] and
+                   j['next_poll'] <= time.time()]
+            for j, counts in zip(due, pool.map(poll, due)):
+                polled = time.time()
+                if counts is None or counts == j['counts']:
+                    j['interval'] = min(j['interval'] * 2, max_interval)
+                    if polled - j['changed'] > max_age:
+                        j['stale'] = True
+                        print('Ingest request {}: no change in {:.0f} minutes, no longer monitored'.format(
+                            j['ingest_id'], (polled - j['changed']) / 60.))
+                else:
+                    j['interval'] = min_interval
+                    j['changed'] = polled
+                    j['counts'] = counts
+                    j['files'] = sum(counts.values())
+                    j['done'] = j['files'] - sum(counts.get(x, 0) for x in ACTIVE_FILE_STATUSES)
+                    if j['files'] and j['done'] == j['files']:
+                        j['completed'] = polled
+                j['next_poll'] = polled + j['interval']
+
+            table = status_table(jobs)
+            print('\n{}'.format(dt.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')))
+            print(table)
+            table.to_csv(save_file, index=False)
+
+            waiting = [j['next_poll'] for j in jobs.values() if j['completed'] is None and not j['stale']]
+            if not waiting:
+                break
+            time.sleep(max(0, min(waiting) - time.time()))
+    finally:
+        pool.close()
+        pool.join()
+    return table
+
+
+def interactive(base_url, username, api_key, api_token, priority, csv_path, workers=8):
+    purge_df = pd.DataFrame()
+
+    # Enter ooinet username. Doesn't need to be an email
+    print('url: %s' %base_url)
+    username = raw_input('Enter ooinet username: {}'.format(username)) or username
+    api_key = raw_input('Enter ooinet key: {}'.format(api_key)) or api_key
+    api_token = raw_input('Enter ooinet token: {}'.format(api_token)) or api_token
+
+    priority = raw_input('Enter priority level (0=highest to 10=lowest) of this ingest <{}:default>: '.format(priority)) or priority
+    try:
+        priority = int(priority)
+    except ValueError:
+        print('Priority must be an integer. Using default priority of 0')
+        priority = 0
+
+    serve = raw_input('\nWould you like to create a recovered or telemetered (recurring) ingestion? <recovered>/telemetered: ') or 'recovered'
+    arrays = raw_input('\nSelect an array for ingestion - CE, CP, GA, GI, GS, GP: ')
+    arrays = arrays.upper().split(', ')
+    platforms = find_platforms(csv_path, arrays)
+
+    print('The following platforms from the previously selected arrays have ingestion csvs.')
+    for platform in platforms:
+        print(platform)
+    selected_platform = raw_input('\nPlease select (comma separated) platform that you would like to ingest: ')
+    selected_platform = selected_platform.upper().split(', ')
+    csvs = find_csvs(csv_path, selected_platform)
+
+    df = csv_select(csvs, serve, username, priority)
+    df = prepare_requests(df)
+
+    unique_ref_des = list(pd.unique(df.refDes.ravel()))
+    unique_ref_des.sort()
+
+    df_telemetered = get_telemetered_requests(base_url, api_key, api_token)
+    recurring = find_recurring(df_telemetered, df)
+
+    yes = raw_input('\nPurge reference designators from the system? y/<n>: ') or 'n'
+
+    if 'y' in yes:
+        print('\nThese reference designators may have ongoing recurring ingestions which MUST be cancelled/suspended before purging.')
+        running = still_running(recurring, change_recurring_ingestion(base_url, api_key, api_token, recurring))
+        if running:
+            print('Not purging {}: recurring ingestions are still running'.format(', '.join(sorted(running))))
+        purge_df = purge(base_url, api_key, api_token, [x for x in unique_ref_des if x not in running], workers)
+    else:
+        if 'telemetered' in serve:
+            change_recurring_ingestion(base_url, api_key, api_token, recurring)
 
-# Enter ooinet username. Doesn't need to be an email
-print 'url: %s' %base_url
-username = raw_input('Enter ooinet username: {}'.format(username)) or username
-api_key = raw_input('Enter ooinet key: {}'.format(api_key)) or api_key
-api_token = raw_input('Enter ooinet token: {}'.format(api_token)) or api_token
-
-priority = raw_input('Enter priority level (0=highest to 10=lowest) of this ingest <{}:default>: '.format(priority)) or priority
-try:
-    priority = int(priority)
-except ValueError:
-    print('Priority must be an integer. Using default priority of 0')
-    priority = 0
-
-serve = raw_input('\nWould you like to create a recovered or telemetered (recurring) ingestion? <recovered>/telemetered: ') or 'recovered'
-arrays = raw_input('\nSelect an array for ingestion - CE, CP, GA, GI, GS, GP: ')
-arrays = arrays.upper().split(', ')
-reg_ex = re.compile('|'.join(arrays))
-result = [y for x in os.walk(csv_path) for y in glob.glob(os.path.join(x[0], '*.csv')) if reg_ex.search(y) and not cabled_reg_ex.search(y)]
-platforms = [x.split('/')[-2] for x in result]
-platforms = set(platforms)
-platforms = list(platforms)
-platforms.sort()
-
-print 'The following platforms from the previously selected arrays have ingestion csvs.'
-for platform in platforms:
-    print platform
-selected_platform = raw_input('\nPlease select (comma separated) platform that you would like to ingest: ')
-selected_platform = selected_platform.upper().split(', ')
-reg_ex = re.compile('|'.join(selected_platform))
-csvs = [y for x in os.walk(csv_path) for y in glob.glob(os.path.join(x[0], '*.csv')) if reg_ex.search(y)]
-csvs.sort()
-
-df = csv_select(csvs, serve)
-df = df.sort_values(['deployment', 'reference_designator'])
-df = df.rename(columns={'filename_mask': 'fileMask', 'reference_designator': 'refDes', 'data_source': 'dataSource',
-                        'parser': 'parserDriver'})
-df = df[pd.notnull(df['fileMask'])]
-
-unique_ref_des = list(pd.unique(df.refDes.ravel()))
-unique_ref_des.sort()
-
-# Get ingestion requests with ID so that we can check if we are ingesting data that already has a recurring ingestion
-all_ingest = get_all_ingest_requests(base_url, api_key, api_token)
-all_ingest = all_ingest.json()
-
-# change dictionary keys because there are duplicate key names in the dictionary
-for l in all_ingest:
-    l['ingest_status'] = l.pop('status')
-    l['ingest_id'] = l.pop('id')
-    l['entryDateStr'] = nc.num2date(l['entryDate'], 'milliseconds since 1970-01-01').strftime('%Y-%m-%d %H:%M:%S')
-    l['modifiedDateStr'] = nc.num2date(l['modifiedDate'], 'milliseconds since 1970-01-01').strftime('%Y-%m-%d %H:%M:%S')
-
-# load the json into a pandas dataframe
-all_ingest = json_normalize(all_ingest, 'ingestRequestFileMasks', ['username', 'type', 'ingest_status', 'ingest_id', 'state', 'priority', 'entryDateStr', 'modifiedDateStr'])
-all_ingest = pd.concat([all_ingest.drop(['refDes'], axis=1), all_ingest['refDes'].apply(pd.Series)], axis=1)
-all_ingest['refDes'] = all_ingest['subsite'] + '-' + all_ingest['node'] + '-' + all_ingest['sensor']
-all_ingest = all_ingest.drop(['node', 'sensor', 'subsite'], axis=1)
-df_telemetered = all_ingest.loc[(all_ingest['state'] == 'RUN') & (all_ingest['type'] == 'TELEMETERED')]
-df_telemetered['changed_status'] = None
-df_telemetered['purged'] = None
-
-print('\nUnique Reference Designators in these ingestion CSV files')
-for rd in unique_ref_des:
-    print rd
-    recurring = recurring.append(df_telemetered[df_telemetered['refDes'] == rd], ignore_index=True)
-
-yes = raw_input('\nPurge reference designators from the system? y/<n>: ') or 'n'
-
-if 'y' in yes:
-    print('\nThese reference designators may have ongoing recurring ingestions which MUST be cancelled/suspended before purging.')
-    state_change = change_recurring_ingestion(api_key, api_token, recurring)
-    for rd in unique_ref_des:
-        split = rd.split('-')
-        ref_des = dict(subsite=split[0], node=split[1], sensor='{}-{}'.format(split[2], split[3]))
-        purge_info = purge_data(base_url, api_key, api_token, ref_des)
-        purge_json = purge_info.json()
-        tdf = pd.DataFrame([purge_json], columns=purge_json.keys())
-        tdf['ReferenceDesignator'] = rd
-        purge_df = purge_df.append(tdf)
-    print('Purge Completed')
-    print(purge_df)
-else:
-    if 'telemetered' in serve:
-        state_change = change_recurring_ingestion(api_key, api_token, recurring)
+    print('\nProceeding with data ingestion\n')
+    ingest_df = submit_ingestions(base_url, api_key, api_token, df, workers)
+    save_results(purge_df, ingest_df)
 
-print('\nProceeding with data ingestion\n')
 
-# add refDesFinal
-wcard_refdes = ['GA03FLMA-RIM01-02-CTDMOG000','GA03FLMB-RIM01-02-CTDMOG000',
-                'GI03FLMA-RIM01-02-CTDMOG000','GI03FLMB-RIM01-02-CTDMOG000',
-                'GP03FLMA-RIM01-02-CTDMOG000','GP03FLMB-RIM01-02-CTDMOG000',
-                'GS03FLMA-RIM01-02-CTDMOG000','GS03FLMB-RIM01-02-CTDMOG000']
+def load_plan(plan_file):
+    # JSON is a subset of YAML, so this reads both
+    with open(plan_file, 'r') as f:
+        plan = yaml.safe_load(f)
 
-df['refDesFinal'] = ''
+    plan.setdefault('base_url', 'https://ooinet.oceanobservatories.org')
+    plan.setdefault('api_key', os.environ.get('OOINET_API_KEY'))
+    plan.setdefault('api_token', os.environ.get('OOINET_API_TOKEN'))
+    for k in ('username', 'api_key', 'api_token', 'csv_path', 'arrays'):
+        if not plan.get(k):
+            raise ValueError('{} is missing from the ingestion plan {}'.format(k, plan_file))
+    if plan.get('recurring', 'persist') not in ('persist', 'cancel', 'suspend'):
+        raise ValueError('recurring must be one of persist, cancel or suspend')
+    return plan
 
-for row in df.iterrows():
 
-    if '#' in row[1]['parserDriver']:
-        continue
-    elif row[1]['parserDriver']:
-        rd = row[1].refDes
-        if rd in wcard_refdes:
-            row[1].refDesFinal = 'false' # the CTDMO decoder will be invoked
-        else:
-            row[1].refDesFinal = 'true' # the CTDMO decoder will not be invoked
-
-        ingest_dict = build_ingest_dict(row[1].to_dict())
-        r = ingest_data(base_url, api_key, api_token, ingest_dict)
-        ingest_json = r.json()
-        tdf = pd.DataFrame([ingest_json], columns=ingest_json.keys())
-        tdf['ReferenceDesignator'] = row[1]['refDes']
-        tdf['state'] = row[1]['state']
-        tdf['type'] = row[1]['type']
-        tdf['deployment'] = row[1]['deployment']
-        tdf['username'] = row[1]['username']
-        tdf['priority'] = row[1]['priority']
-        tdf['refDesFinal'] = row[1]['refDesFinal']
-        tdf['fileMask'] = row[1]['fileMask']
-        ingest_df = ingest_df.append(tdf)
+def run_plan(plan):
+    """
+    Runs an ingestion without any prompts
+    :param plan: dictionary loaded from a plan file by load_plan
+    """
+    base_url, api_key, api_token = plan['base_url'], plan['api_key'], plan['api_token']
+    serve = plan.get('type', 'recovered').lower()
+
+    purge_df = pd.DataFrame()
+    running = set()
+    arrays = [x.upper() for x in plan['arrays']]
+    platforms = [x.upper() for x in plan.get('platforms') or find_platforms(plan['csv_path'], arrays)]
+    csvs = find_csvs(plan['csv_path'], platforms)
+
+    df = plan_select(csvs, plan)
+    if df.empty:
+        print('No ingestion csvs match the plan')
+        return
+    df = prepare_requests(df)
+
+    unique_ref_des = list(pd.unique(df.refDes.ravel()))
+    unique_ref_des.sort()
+
+    df_telemetered = get_telemetered_requests(base_url, api_key, api_token)
+    recurring = find_recurring(df_telemetered, df)
+
+    state = plan.get('recurring', 'persist')
+    if state != 'persist' and not recurring.empty and (plan.get('purge') or 'telemetered' in serve):
+        state_change = change_states(base_url, api_key, api_token, sorted(set(recurring['ingest_id'])), state,
+                                     plan.get('workers', 8))
+        running = still_running(recurring, state_change)
+
+    if plan.get('purge'):
+        if running:
+            print('Not purging {}: recurring ingestions are still running'.format(', '.join(sorted(running))))
+        purge_df = purge(base_url, api_key, api_token, [x for x in unique_ref_des if x not in running],
+                         plan.get('workers', 8))
+
+    print('\nProceeding with data ingestion\n')
+    ingest_df = submit_ingestions(base_url, api_key, api_token, df, plan.get('workers', 8))
+    save_results(purge_df, ingest_df, plan.get('save_dir', '.'))
+
+    if plan.get('monitor') and 'id' in ingest_df:
+        ingest_ids = [int(x) for x in ingest_df['id'].dropna()]
+        save_file = os.path.join(plan.get('save_dir', '.'),
+                                 '{}_monitor.csv'.format(dt.datetime.utcnow().strftime('%Y%m%d_%H%M%S')))
+        monitor_ingestions(base_url, api_key, api_token, ingest_ids, save_file, plan.get('workers', 8))
+
+
+if __name__ == '__main__':
+    desired_width = 320
+    pd.set_option('display.width', desired_width)
+
+    parser = argparse.ArgumentParser(description='Create uFrame ingestion requests from the ingestion csvs')
+    parser.add_argument('--plan', help='YAML or JSON ingestion plan. Runs without prompts')
+    parser.add_argument('--monitor', type=int, nargs='+', metavar='ID', help='follow these ingest requests')
+    parser.add_argument('--base_url', default='https://ooinet.oceanobservatories.org')
+    parser.add_argument('--save_file', default='ingest_monitor.csv', help='status csv written by --monitor')
+    args = parser.parse_args()
+
+    if args.plan:
+        run_plan(load_plan(args.plan))
+    elif args.monitor:
+        monitor_ingestions(args.base_url, os.environ.get('OOINET_API_KEY'), os.environ.get('OOINET_API_TOKEN'),
+                           args.monitor, args.save_file)
     else:
-        continue
+        # OOINET authorization information and base_url
+        username = 'michaesm'
+
+        # ooinet production
+        base_url = 'https://ooinet.oceanobservatories.org'
+        api_key = 'username'
+        api_token = 'token'
+
+        # ooinet-dev-01
+        # base_url = 'https://ooinet-dev-01.oceanobservatories.org'
+        # api_key = 'username'
+        # api_token = 'token'
+
+        # ooinet-dev-03
+        # base_url = 'https://ooinet-dev-03.oceanobservatories.org'
+        # api_key = 'username'
+        # api_token = 'token'
+
+        # ooinet-dev-04
+        # base_url = 'https://ooinet-dev-04.oceanobservatories.org'
+        # api_key = 'username'
+        # api_token = 'token'
 
-print ingest_df
-utc_time = dt.datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+        priority = 1
+        csv_path = '/local_path_to_ingestion-csvs/'
 
-purge_df.to_csv('{}_purged.csv'.format(utc_time), index=False)
-ingest_df.to_csv('{}_ingested.csv'.format(utc_time), index=False)
\ No newline at end of file
+        interactive(base_url, username, api_key, api_token, priority, csv_path)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+@file dav_index.py
+@brief Cached listing of the raw data WebDAV mount, used in place of glob.glob and os.stat on the mount
+@purpose Every glob, getsize and getmtime on the WebDAV mount is a network round trip. The listing of each
+platform/deployment directory (e.g. CE01ISSM/D00001) is read once with a parallel scandir walk and saved with the
+size and mtime of every file. Later runs only list again the directories whose mtime has changed, and file masks are
+matched against the saved listing in memory
+@usage
+dav_mount Directory on local computer to OOI Raw Data dav server
+index_dir Where the listings are saved. Created if it does not exist
+@example
+from tools import dav_index
+dav = dav_index.DavIndex('/Volumes/dav/')
+for path, size, mtime in dav.glob('/Volumes/dav/CE01ISSM/D00001/cg_data/dcl35/presf/*.hex'):
+    print(path, size)
+@note A file that is appended to in place does not change the mtime of its directory, so its size and mtime are only
+updated when something else in the directory changes, or with DavIndex(..., rescan=True)
+"""
+
+import fnmatch
+import glob
+import os
+import re
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+from tools.atomic_file import atomic_write
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+INDEX_DIR = os.path.join(os.path.expanduser('~'), '.ooi_dav_index')
+magic_check = re.compile('[*?[]')
+
+
+def scan_dir(path):
+    """
+    :return: tuple of (directory mtime, list of subdirectory names, list of (file name, size, mtime)), or None if the
+    directory can't be read
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+        subdirs = []
+        files = []
+        for entry in scandir(path):
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            else:
+                stat = entry.stat()
+                files.append((entry.name, stat.st_size, stat.st_mtime))
+    except OSError:
+        return None
+    return mtime, subdirs, files
+
+
+def match(name, pattern):
+    # like glob, wildcards don't match hidden files
+    if name.startswith('.') and not pattern.startswith('.'):
+        return False
+    return fnmatch.fnmatchcase(name, pattern)
+
+
+def dir_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class DavIndex(object):
+    def __init__(self, dav_mount, index_dir=INDEX_DIR, workers=16, depth=2, rescan=False):
+        """
+        :param depth: number of directory levels below dav_mount that make up one saved listing
+        :param workers: number of directories listed at once
+        :param rescan: list every directory again, even if its mtime has not changed
+        """
+        self.dav_mount = os.path.abspath(dav_mount)
+        self.index_dir = index_dir
+        self.workers = workers
+        self.depth = depth
+        self.rescan = rescan
+        self.tables = {}  # prefix: (sorted relative paths, sizes, mtimes)
+        self.pool = None
+
+    def index_file(self, prefix):
+        return os.path.join(self.index_dir, '{}.npz'.format(prefix.replace('/', '__') or '_root'))
+
+    def load(self, prefix):
+        # {directory relative to the prefix: (mtime, subdirectories, files)} from the saved listing
+        try:
+            saved = np.load(self.index_file(prefix))
+            dirs, dir_mtimes, file_dirs = saved['dirs'], saved['dir_mtimes'], saved['file_dirs']
+            names, sizes, mtimes = saved['names'], saved['sizes'], saved['mtimes']
+        except (IOError, OSError, KeyError, ValueError):
+            return {}
+
+        listing = dict((str(d), (m, [], [])) for d, m in zip(dirs, dir_mtimes))
+        for d in listing:
+            if d:
+                listing[os.path.dirname(d)][1].append(os.path.basename(d))
+        for i, name, size, mtime in zip(file_dirs, names, sizes, mtimes):
+            listing[str(dirs[i])][2].append((str(name), int(size), float(mtime)))
+        return listing
+
+    def save(self, prefix, listing):
+        if not os.path.isdir(self.index_dir):
+            os.makedirs(self.index_dir)
+        dirs = sorted(listing)
+        file_dirs, names, sizes, mtimes = [], [], [], []
+        for i, d in enumerate(dirs):
+            for name, size, mtime in listing[d][2]:
+                file_dirs.append(i)
+                names.append(name)
+                sizes.append(size)
+                mtimes.append(mtime)
+        with atomic_write(self.index_file(prefix), 'wb') as f:
+            np.savez(f, dirs=np.array(dirs, dtype=np.unicode_), dir_mtimes=np.array([listing[d][0] for d in dirs]),
+                     file_dirs=np.array(file_dirs, dtype=np.int32), names=np.array(names, dtype=np.unicode_),
+                     sizes=np.array(sizes, dtype=np.int64), mtimes=np.array(mtimes, dtype=np.float64))
+
+    def refresh(self, prefix):
+        """
+        Brings the listing of one prefix up to date. Every directory is checked with one stat, and only the
+        directories that are new or whose mtime has changed are listed again
+        :return: number of directories listed
+        """
+        if self.pool is None:
+            self.pool = ThreadPool(self.workers)
+        old = {} if self.rescan else self.load(prefix)
+        root = os.path.join(self.dav_mount, prefix)
+
+        listing = {}
+        listed = 0
+        todo = ['']
+        while todo:
+            mtimes = self.pool.map(dir_mtime, [os.path.join(root, d) for d in todo])
+            changed = []
+            next_todo = []
+            for d, mtime in zip(todo, mtimes):
+                if mtime is None:
+                    continue  # removed since the last refresh
+                if d in old and old[d][0] == mtime:
+                    listing[d] = old[d]
+                    next_todo.extend(os.path.join(d, x) for x in old[d][1])
+                else:
+                    changed.append(d)
+
+            for d, result in zip(changed, self.pool.map(scan_dir, [os.path.join(root, d) for d in changed])):
+                if result is not None:
+                    listing[d] = result
+                    next_todo.extend(os.path.join(d, x) for x in result[1])
+                    listed += 1
+            todo = next_todo
+
+        self.save(prefix, listing)
+        self.tables[prefix] = self.to_table(listing)
+        return listed
+
+    @staticmethod
+    def to_table(listing):
+        rows = sorted((os.path.join(d, name), size, mtime) for d in listing for name, size, mtime in listing[d][2])
+        paths = np.array([x[0] for x in rows], dtype=np.unicode_) if rows else np.array([], dtype=np.unicode_)
+        return paths, np.array([x[1] for x in rows], dtype=np.int64), np.array([x[2] for x in rows], dtype=np.float64)
+
+    def split(self, pattern):
+        # (prefix of the listing that holds the pattern, pattern relative to that prefix)
+        rel = os.path.relpath(os.path.abspath(pattern), self.dav_mount)
+        parts = rel.split(os.sep)
+        literal = []
+        for p in parts[:-1]:
+            if magic_check.search(p) or len(literal) == self.depth:
+                break
+            literal.append(p)
+        return '/'.join(literal), '/'.join(parts[len(literal):])
+
+    def glob(self, pattern):
+        """
+        In-memory equivalent of glob.glob for files below the dav mount. Like glob, wildcards do not match across
+        directories. Directories themselves are never returned
+        :return: list of (path, size in bytes, mtime) sorted by path
+        """
+        prefix, rel = self.split(pattern)
+        if prefix not in self.tables:
+            self.refresh(prefix)
+        paths, sizes, mtimes = self.tables[prefix]
+
+        # narrow down to the paths below the literal part of the pattern before matching
+        parts = rel.split('/')
+        literal = []
+        for p in parts:
+            if magic_check.search(p):
+                break
+            literal.append(p)
+        root = os.path.join(self.dav_mount, prefix)
+        if len(literal) == len(parts):  # no wildcards, so at most one file
+            i = np.searchsorted(paths, rel, 'left')
+            if i < len(paths) and paths[i] == rel:
+                return [(os.path.join(root, paths[i]), int(sizes[i]), float(mtimes[i]))]
+            return []
+
+        # the directory must match the literal components exactly, so search below lead + '/' and not just lead
+        lead = '/'.join(literal) + '/' if literal else ''
+        lo = np.searchsorted(paths, lead, 'left')
+        hi = np.searchsorted(paths, lead + u'\uffff', 'right')
+
+        matches = []
+        for i in range(lo, hi):
+            path_parts = paths[i].split('/')
+            if len(path_parts) == len(parts) and all(match(x, p) for x, p in zip(path_parts[len(literal):],
+                                                                                parts[len(literal):])):
+                matches.append((os.path.join(root, paths[i]), int(sizes[i]), float(mtimes[i])))
+        return matches
+
+    def verify(self, pattern):
+        """
+        Compare glob with glob.glob on the mount itself, e.g. to check a new mask or a stale listing
+        :return: tuple of (paths only glob.glob found, paths only the index found)
+        """
+        found = set(glob.glob(pattern))
+        found = set(x for x in found if not os.path.isdir(x))
+        indexed = set(x[0] for x in self.glob(pattern))
+        return sorted(found - indexed), sorted(indexed - found)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
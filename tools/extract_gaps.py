@@ -4,44 +4,199 @@
 @author Lori Garzio
 @email lgarzio@marine.rutgers.edu
 @brief Read the .json output from analyze_nc_data.py and extract the data gaps
-@purpose Provide a human-readable file for data gaps
+@purpose Provide a human-readable file for data gaps, and a searchable catalog of the gaps from every review
 @usage
 dataset Path to .json output from analyze_nc_data.py
 save_dir Location to save output
+review_dir Directory containing the .json output of one or more reviews (searched recursively)
+catalog_db Path to the sqlite gap catalog. Created if it does not exist
+@example
+from tools import extract_gaps
+extract_gaps.update_catalog('/Users/lgarzio/Documents/OOI/DataReviews', 'gap_catalog.db')
+extract_gaps.query_gaps('gap_catalog.db', ref_des='CE09OSPM', min_days=5, begin='2015-01-01', end='2016-01-01')
 """
 
-import simplejson as json
-import pandas as pd
+try: import simplejson as json
+except ImportError: import json
 import os
+import sqlite3
+import pandas as pd
 
 dataset = '/Users/lgarzio/Documents/OOI/DataReviews/CE06ISSM-RID16-07-NUTNRB000_recovered_inst-nutnr_b_instrument_recovered-processed_on_2017-03-22T172633.json'
 save_dir = '/Users/lgarzio/Documents/OOI/DataReviews/'
+review_dir = '/Users/lgarzio/Documents/OOI/DataReviews/'
+catalog_db = os.path.join(review_dir, 'gap_catalog.db')
+
+columns = ['ref_des', 'filename', 'stream', 'deployment', 'deploy_begin', 'deploy_end',
+           'data_begin (file)', 'data_end (file)', 'gaps']
+
 
-def extract_gaps(dataset,save_dir):
-    file = open(dataset, 'r')
-    data = json.load(file)
+def read_files(data):
+    # yields one row per data file listed in the .json output
     ref_des = data.get('ref_des')
     for d in data['deployments']:
-        deployment = d
-        deploy_begin = data['deployments'][d]['begin']
+        deploy_begin = data['deployments'][d]['begin'] if 'begin' in data['deployments'][d] else data['deployments'][d]['start']
         deploy_end = data['deployments'][d]['end']
         for s in data['deployments'][d]['streams']:
-            stream = s
             for x in data['deployments'][d]['streams'][s]['files']:
-                fName = x
-                gaps = data['deployments'][d]['streams'][s]['files'][x]['time_gaps']
-                data_begin = data['deployments'][d]['streams'][s]['files'][x]['data_start']
-                data_end = data['deployments'][d]['streams'][s]['files'][x]['data_end']
-
-                try:
-                    df
-                    df.append((ref_des,fName,stream,deployment,deploy_begin,deploy_end,data_begin,data_end,gaps))
-                except NameError:
-                    df = []
-                    df.append((ref_des,fName,stream,deployment,deploy_begin,deploy_end,data_begin,data_end,gaps))
-
-    df = pd.DataFrame(df, columns=['ref_des', 'filename', 'stream', 'deployment', 'deploy_begin', 'deploy_end',
-                                   'data_begin (file)', 'data_end (file)', 'gaps'])
+                file_info = data['deployments'][d]['streams'][s]['files'][x]
+                yield (ref_des, x, s, d, deploy_begin, deploy_end, file_info['data_start'], file_info['data_end'],
+                       file_info['time_gaps'])
+
+
+def extract_gaps(dataset, save_dir):
+    with open(dataset, 'r') as file:
+        data = json.load(file)
+    ref_des = data.get('ref_des')
+
+    df = pd.DataFrame(list(read_files(data)), columns=columns)
     df.to_csv(os.path.join(save_dir, ref_des + '-data_gaps.csv'), index=False)
 
-extract_gaps(dataset,save_dir)
\ No newline at end of file
+
+def to_epoch(timestamp):
+    # seconds since 1970-01-01 for an ISO 8601 timestamp string
+    return pd.to_datetime(timestamp).value / 1e9
+
+
+def connect_catalog(catalog_db):
+    """
+    Opens the gap catalog, creating the tables if needed. Gap intervals are indexed in an R*Tree so that time
+    overlap queries do not scan the whole catalog. If the local sqlite was built without the R*Tree module, a
+    b-tree index on the interval columns is used instead.
+    :param catalog_db: path to the sqlite catalog
+    :return: sqlite3 connection
+    """
+    con = sqlite3.connect(catalog_db)
+    con.execute('CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY, mtime REAL, size INTEGER)')
+    con.execute('CREATE TABLE IF NOT EXISTS gaps (id INTEGER PRIMARY KEY, source TEXT, ref_des TEXT, stream TEXT, '
+                'deployment TEXT, filename TEXT, gap_start TEXT, gap_end TEXT, start_epoch REAL, end_epoch REAL, '
+                'duration_days REAL)')
+    con.execute('CREATE INDEX IF NOT EXISTS gaps_source ON gaps (source)')
+    con.execute('CREATE INDEX IF NOT EXISTS gaps_ref_des ON gaps (ref_des, duration_days)')
+    try:
+        con.execute('CREATE VIRTUAL TABLE IF NOT EXISTS gaps_rtree USING rtree(id, start_epoch, end_epoch)')
+    except sqlite3.OperationalError:
+        con.execute('CREATE INDEX IF NOT EXISTS gaps_interval ON gaps (start_epoch, end_epoch)')
+    return con
+
+
+def has_rtree(con):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE name = 'gaps_rtree'").fetchone() is not None
+
+
+def remove_source(con, source):
+    if has_rtree(con):
+        con.execute('DELETE FROM gaps_rtree WHERE id IN (SELECT id FROM gaps WHERE source = ?)', (source,))
+    con.execute('DELETE FROM gaps WHERE source = ?', (source,))
+    con.execute('DELETE FROM sources WHERE source = ?', (source,))
+
+
+def insert_source(con, source, data):
+    rows = []
+    for ref_des, fName, stream, deployment, _, _, _, _, gaps in read_files(data):
+        for g in gaps:
+            start_epoch = to_epoch(g[0])
+            end_epoch = to_epoch(g[1])
+            rows.append((source, ref_des, stream, deployment, fName, g[0], g[1], start_epoch, end_epoch,
+                         (end_epoch - start_epoch) / 86400.))
+
+    con.executemany('INSERT INTO gaps (source, ref_des, stream, deployment, filename, gap_start, gap_end, '
+                    'start_epoch, end_epoch, duration_days) VALUES (?,?,?,?,?,?,?,?,?,?)', rows)
+    if has_rtree(con) and rows:
+        con.execute('INSERT INTO gaps_rtree SELECT id, start_epoch, end_epoch FROM gaps WHERE source = ?', (source,))
+    return len(rows)
+
+
+def update_catalog(review_dir, catalog_db):
+    """
+    Adds the gaps from every .json output under review_dir to the catalog. Only files that are new or have changed
+    since the last update are read; entries for files that no longer exist are removed.
+    :param review_dir: directory searched recursively for .json output from analyze_nc_data.py
+    :param catalog_db: path to the sqlite catalog
+    :return: number of .json files (re)loaded into the catalog
+    """
+    con = connect_catalog(catalog_db)
+    known = dict((row[0], (row[1], row[2])) for row in con.execute('SELECT source, mtime, size FROM sources'))
+
+    found = set()
+    loaded = 0
+    for root, dirs, files in os.walk(review_dir):
+        for f in files:
+            if not f.endswith('.json'):
+                continue
+            source = os.path.abspath(os.path.join(root, f))
+            stat = os.stat(source)
+            found.add(source)
+            if known.get(source) == (stat.st_mtime, stat.st_size):
+                continue  # unchanged since the last update
+
+            try:
+                with open(source, 'r') as file:
+                    data = json.load(file)
+                if not isinstance(data, dict) or 'deployments' not in data:
+                    raise ValueError('no deployments')
+                with con:
+                    remove_source(con, source)
+                    insert_source(con, source, data)
+                    con.execute('INSERT INTO sources (source, mtime, size) VALUES (?,?,?)',
+                                (source, stat.st_mtime, stat.st_size))
+                loaded += 1
+            except (ValueError, KeyError, TypeError):
+                # not (or an older style of) check_data .json output. Drop the gaps of an earlier version of the file,
+                # and record it without gaps so that it is only read again once it changes
+                with con:
+                    remove_source(con, source)
+                    con.execute('INSERT INTO sources (source, mtime, size) VALUES (?,?,?)',
+                                (source, stat.st_mtime, stat.st_size))
+
+    with con:
+        for source in set(known) - found:
+            remove_source(con, source)
+    con.close()
+    return loaded
+
+
+def query_gaps(catalog_db, ref_des=None, min_days=None, begin=None, end=None):
+    """
+    Search the gap catalog
+    :param catalog_db: path to the sqlite catalog
+    :param ref_des: partially- (e.g. CE09OSPM) or fully-qualified reference designator
+    :param min_days: only return gaps at least this many days long
+    :param begin: only return gaps that end after this date
+    :param end: only return gaps that start before this date
+    :return: dataframe of the matching gaps
+    """
+    con = connect_catalog(catalog_db)
+    where = []
+    params = []
+    table = 'gaps'
+    if begin is not None or end is not None:
+        lo = to_epoch(begin) if begin is not None else float('-inf')
+        hi = to_epoch(end) if end is not None else float('inf')
+        if has_rtree(con):
+            # the R*Tree stores 32-bit floats, so it is used as a coarse filter before the exact comparison
+            table = 'gaps JOIN gaps_rtree ON gaps.id = gaps_rtree.id'
+            where.append('gaps_rtree.end_epoch >= ? AND gaps_rtree.start_epoch <= ?')
+            params.extend([lo, hi])
+        where.append('gaps.end_epoch >= ? AND gaps.start_epoch <= ?')
+        params.extend([lo, hi])
+    if ref_des:
+        where.append('gaps.ref_des LIKE ?')
+        params.append(ref_des + '%')
+    if min_days is not None:
+        where.append('gaps.duration_days >= ?')
+        params.append(min_days)
+
+    sql = 'SELECT gaps.ref_des, gaps.stream, gaps.deployment, gaps.filename, gaps.gap_start, gaps.gap_end, ' \
+          'gaps.duration_days, gaps.source FROM {}'.format(table)
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY gaps.ref_des, gaps.start_epoch'
+
+    df = pd.read_sql_query(sql, con, params=params)
+    con.close()
+    return df
+
+
+if __name__ == '__main__':
+    extract_gaps(dataset, save_dir)
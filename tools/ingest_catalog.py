@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+@file ingest_catalog.py
+@brief Index of the ingestion csvs (https://github.com/ooi-integration/ingestion-csvs) in a local sqlite catalog
+@purpose Let the ingestion tools find and read ingestion csvs without walking and re-parsing the whole checkout on
+every run. Each *_ingest.csv is stored with its platform, deployment number, csv type (D or R), mtime and parsed rows,
+and is only read again when it changes
+@usage
+csv_path Path to the local copy of the ingestion-csvs repo
+catalog_db Path to the sqlite catalog. Created if it does not exist. A catalog can hold several checkouts
+@example
+from tools import ingest_catalog
+csvs = ingest_catalog.find_csvs('/Users/mikesmith/Documents/git/ooi-integration/ingestion-csvs/', ['CE01ISSM'],
+                                csv_types=['R'], deployments=[3])
+df = ingest_catalog.read_csv(csvs[0])
+"""
+
+import json
+import os
+import re
+import sqlite3
+import pandas as pd
+
+INGEST_CATALOG = os.path.join(os.path.expanduser('~'), '.ooi_ingest_catalog.db')
+ingest_reg_ex = re.compile('^.+_([DR])0*([0-9]+)_ingest\.csv$')
+
+# checkouts already refreshed by this process, so that repeated queries don't walk the checkout again
+_refreshed = set()
+
+
+def connect_catalog(catalog_db):
+    con = sqlite3.connect(catalog_db)
+    con.execute('CREATE TABLE IF NOT EXISTS csvs (path TEXT PRIMARY KEY, root TEXT, platform TEXT, deployment INTEGER, '
+                'csv_type TEXT, mtime REAL, size INTEGER, header TEXT)')
+    con.execute('CREATE INDEX IF NOT EXISTS csvs_platform ON csvs (root, platform, deployment)')
+    con.execute('CREATE TABLE IF NOT EXISTS csv_rows (path TEXT, row INTEGER, data TEXT, PRIMARY KEY (path, row))')
+    return con
+
+
+def parse_name(path):
+    # (platform, deployment number, csv type) for an ingestion csv, or None if the name doesn't match
+    match = ingest_reg_ex.match(os.path.basename(path))
+    if match is None:
+        return None
+    return os.path.basename(os.path.dirname(path)), int(match.group(2)), match.group(1)
+
+
+def load_csv(con, root, path, stat):
+    # (re)parse one ingestion csv into the catalog. A csv that can't be parsed is recorded with no rows, so that one bad
+    # sheet doesn't stop the refresh, and it is only read again once it changes
+    try:
+        df = pd.read_csv(path)
+    except ValueError as e:  # includes pandas' EmptyDataError and ParserError
+        print('Could not read ingestion csv {}: {}'.format(path, e))
+        df = pd.DataFrame()
+    rows = [(path, i, json.dumps(row)) for i, row in enumerate(df.astype(object).values.tolist())]
+    platform, deployment, csv_type = parse_name(path)
+
+    con.execute('DELETE FROM csv_rows WHERE path = ?', (path,))
+    con.executemany('INSERT INTO csv_rows (path, row, data) VALUES (?,?,?)', rows)
+    con.execute('INSERT OR REPLACE INTO csvs (path, root, platform, deployment, csv_type, mtime, size, header) '
+                'VALUES (?,?,?,?,?,?,?,?)', (path, root, platform, deployment, csv_type, stat.st_mtime, stat.st_size,
+                                             json.dumps(list(df.columns))))
+
+
+def remove_csv(con, path):
+    con.execute('DELETE FROM csv_rows WHERE path = ?', (path,))
+    con.execute('DELETE FROM csvs WHERE path = ?', (path,))
+
+
+def refresh_catalog(csv_path, catalog_db=INGEST_CATALOG):
+    """
+    Brings the catalog up to date with the checkout. Only ingestion csvs that are new or have changed since the last
+    refresh are parsed; entries for csvs that no longer exist are removed. The .git directory is never walked.
+    :return: number of ingestion csvs (re)loaded into the catalog
+    """
+    root = os.path.abspath(csv_path)
+    con = connect_catalog(catalog_db)
+    known = dict((row[0], (row[1], row[2])) for row in
+                 con.execute('SELECT path, mtime, size FROM csvs WHERE root = ?', (root,)))
+
+    found = set()
+    loaded = 0
+    for dirpath, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for f in files:
+            path = os.path.join(dirpath, f)
+            if parse_name(path) is None:
+                continue
+            stat = os.stat(path)
+            found.add(path)
+            if known.get(path) == (stat.st_mtime, stat.st_size):
+                continue  # unchanged since the last refresh
+            with con:
+                load_csv(con, root, path, stat)
+            loaded += 1
+
+    with con:
+        for path in set(known) - found:
+            remove_csv(con, path)
+    con.close()
+    _refreshed.add((catalog_db, root))
+    return loaded
+
+
+def connect_current(csv_path, catalog_db):
+    # connection to a catalog that has been refreshed for the checkout by this process
+    root = os.path.abspath(csv_path)
+    if (catalog_db, root) not in _refreshed:
+        refresh_catalog(root, catalog_db)
+    return connect_catalog(catalog_db), root
+
+
+def find_platforms(csv_path, arrays=None, catalog_db=INGEST_CATALOG):
+    """
+    :param arrays: list of arrays (e.g. CE) or platform prefixes. Default: every platform
+    :return: sorted list of the platforms that have ingestion csvs
+    """
+    con, root = connect_current(csv_path, catalog_db)
+    platforms = [row[0] for row in con.execute('SELECT DISTINCT platform FROM csvs WHERE root = ? ORDER BY platform',
+                                               (root,))]
+    con.close()
+    if arrays:
+        platforms = [x for x in platforms if x.startswith(tuple(arrays))]
+    return platforms
+
+
+def find_csvs(csv_path, platforms=None, csv_types=None, deployments=None, catalog_db=INGEST_CATALOG):
+    """
+    :param platforms: list of platforms or platform prefixes (e.g. CE05MOAS for every CE05MOAS glider). Default: all
+    :param csv_types: list of csv types, D and/or R. Default: both
+    :param deployments: list of deployment numbers. Default: every deployment
+    :return: sorted list of paths to the matching ingestion csvs
+    """
+    where = ['root = ?']
+    params = []
+    if platforms:
+        where.append('(' + ' OR '.join(['platform LIKE ?'] * len(platforms)) + ')')
+        params.extend(x + '%' for x in platforms)
+    if csv_types:
+        where.append('csv_type IN ({})'.format(', '.join('?' * len(csv_types))))
+        params.extend(x.upper() for x in csv_types)
+    if deployments:
+        where.append('deployment IN ({})'.format(', '.join('?' * len(deployments))))
+        params.extend(int(x) for x in deployments)
+
+    con, root = connect_current(csv_path, catalog_db)
+    csvs = [row[0] for row in con.execute('SELECT path FROM csvs WHERE {} ORDER BY path'.format(' AND '.join(where)),
+                                          [root] + params)]
+    con.close()
+    return csvs
+
+
+def read_csv(csv, catalog_db=INGEST_CATALOG):
+    """
+    Rows of one ingestion csv, read from the catalog. The csv is parsed again first if it changed since it was indexed
+    :return: dataframe with the same columns as the csv
+    """
+    path = os.path.abspath(csv)
+    if parse_name(path) is None:
+        return pd.read_csv(path)  # not named like an ingestion csv, so it isn't indexed
+    stat = os.stat(path)
+    con = connect_catalog(catalog_db)
+    row = con.execute('SELECT root, mtime, size, header FROM csvs WHERE path = ?', (path,)).fetchone()
+    if row is None or (row[1], row[2]) != (stat.st_mtime, stat.st_size):
+        with con:
+            load_csv(con, row[0] if row else os.path.dirname(os.path.dirname(path)), path, stat)
+        row = con.execute('SELECT root, mtime, size, header FROM csvs WHERE path = ?', (path,)).fetchone()
+
+    data = [json.loads(x[0]) for x in con.execute('SELECT data FROM csv_rows WHERE path = ? ORDER BY row', (path,))]
+    con.close()
+    return pd.DataFrame(data, columns=json.loads(row[3]))
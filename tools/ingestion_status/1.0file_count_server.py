@@ -6,9 +6,13 @@ Created on Mon Feb 06 2017
 """
 
 import pandas as pd
-import glob
 import os
 import time
+import sys
+
+# run from anywhere: make the tools package importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from tools import dav_index, ingest_catalog
 
 start_time = time.time()
 
@@ -30,6 +34,8 @@ dav_mount = '/Volumes/dav/'
 splitter = '/OMC/'
 splitter_C = '/rsn_data/DVT_Data/'
 splitter_CC = '/RSN/'
+# compare every mask against glob.glob on the mount as well, and print any difference from the cached dav listing
+verify_masks = False
 
 # select a site
 site_name = 'Endurance'
@@ -45,155 +51,106 @@ outputfile = main + ingest_key + '/'
 datein = pd.to_datetime('today')
 
 
+def to_web_dir(mask, platform):
+    # location of the files of an OMC/RSN file mask on the dav mount
+    try:
+        return os.path.join(dav_mount, mask.split(splitter)[1])
+    except IndexError:
+        try:
+            return os.path.join(dav_mount, platform, mask.split(splitter_C)[1])
+        except IndexError:
+            return os.path.join(dav_mount, mask.split(splitter_CC)[1])
+
+
+def count_files(filereader):
+    """
+    Adds number_files, file <= 1k, file > 1K, file of today and Automated_status to the rows of an ingestion sheet.
+    All the matched files are counted at once from the dav listing
+    """
+    empty = filereader['filename_mask'] == ''
+    bad = ~empty & ~filereader['filename_mask'].map(lambda x: hasattr(x, 'split'))
+    check = filereader[~empty & ~bad]
+    web_dirs = pd.Series([to_web_dir(m, p) for m, p in zip(check['filename_mask'], check['platform'])],
+                         index=check.index)
+
+    if verify_masks:
+        for web_dir in web_dirs:
+            missing, extra = dav.verify(web_dir)
+            if missing or extra:
+                print('dav listing differs from glob.glob for {}: missing {}, extra {}'.format(web_dir, missing, extra))
+
+    # one row per matched file: (ingestion sheet row, size, mtime)
+    matches = pd.DataFrame([(i, size, mtime) for i, web_dir in zip(web_dirs.index, web_dirs)
+                            for path, size, mtime in dav.glob(web_dir)], columns=['row', 'size', 'mtime'])
+    today = time.mktime(datein.date().timetuple())  # local midnight, as compared by time.ctime
+    matches['small'] = matches['size'] <= 1024  # 513410
+    matches['large'] = matches['size'] > 1024
+    matches['today'] = (matches['mtime'] >= today) & (matches['mtime'] < today + 86400)
+    counts = matches.groupby('row').agg({'size': 'count', 'small': 'sum', 'large': 'sum', 'today': 'sum'})
+    counts = counts.reindex(web_dirs.index).fillna(0).astype(int)
+
+    filereader['web_dir'] = filereader['filename_mask']
+    filereader.loc[web_dirs.index, 'web_dir'] = web_dirs
+    for column, count in [('number_files', 'size'), ('file <= 1k', 'small'), ('file > 1K', 'large'),
+                          ('file of today', 'today')]:
+        filereader[column] = 'file_mask is empty'
+        filereader.loc[bad, column] = 'file_mask w attribute error'
+        filereader.loc[counts.index, column] = counts[count].astype(str)
+    filereader['Automated_status'] = ''
+    filereader.loc[counts.index, 'Automated_status'] = counts['size'].map(lambda x: 'Missing' if x == 0 else 'Available')
+    return filereader
+
+
 # start script
+# cached listing of the dav mount: each directory is listed once with scandir from a thread pool, and on later runs
+# only when its mtime has changed
+dav = dav_index.DavIndex(dav_mount)
 df = pd.DataFrame()
-for root, dirs, files in os.walk(rootdir):
-    for item in dirs:
-        if item.startswith(ingest_key):
-            rootCP = root + item + '/'
-            for rCP, dirCP, fileCP in os.walk(rootCP):
-                for f in fileCP:
-                    print f
-                    if f.endswith(ingestion_file):
-                        with open(os.path.join(rCP,f),'r') as csv_file:
-                            filereader = pd.read_csv(csv_file)
-                            if 'Unnamed: 4' in filereader.columns:
-                                filereader = filereader.rename(columns={'Unnamed: 4': 'status'})
-                            # remove rows with empty Reference Designators
-                            filereader.dropna(subset=['reference_designator'], inplace=True)
-
-                            # remove rows with empty cells
-                            filereader.dropna(how="all", inplace=True)
-
-                            # replace NAN by empty string
-                            filereader.fillna('', inplace=True)
-
-                            # add the file name as a column
-                            filereader['ingest_csv_filename'] = str(f)
-
-                            # add to data frame --> platform name || deployment number || results
-                            filereader['platform'] = filereader['ingest_csv_filename'].str.split('_').str[0].str[0:8]
-                            filereader['deployment#'] = filereader['ingest_csv_filename'].str.split('_').str[1].str[3:6]
-                            filereader['number_files'] = ''
-                            filereader['file <= 1k'] = ''
-                            filereader['file > 1K'] = ''
-                            filereader['file of today'] = ''
-                            filereader['Automated_status'] = ''
-
-                            # check file path on dav
-                            file_num = []
-                            size1kless = []
-                            size1kplus = []
-                            todayfile = []
-                            statusfile = []
-
-                            index_i = 0
-                            for row in filereader.itertuples():
-                                if row.filename_mask is not '':
-                                    try:
-                                        try:
-                                            web_dir = os.path.join(dav_mount, row.filename_mask.split(splitter)[1])
-                                        except IndexError:
-                                            try:
-                                                web_dir = os.path.join(dav_mount, row.platform, row.filename_mask.split(splitter_C)[1])
-                                            except IndexError:
-                                                web_dir = os.path.join(dav_mount, row.filename_mask.split(splitter_CC)[1])
-
-                                        file_match = glob.glob(web_dir)
-
-                                        compare_2_date = datein.strftime("%d/%m/%Y")
-                                        file_1K_size = 0
-                                        file_1Kplus_size = 0
-                                        file_of_today = 0
-                                        kk = 0
-                                        for file in file_match:
-                                            if os.path.isfile(file):
-                                                file_modified = pd.to_datetime(time.ctime(os.path.getmtime(file)))
-                                                file_modified = file_modified.strftime("%d/%m/%Y")
-                                                get_size = os.path.getsize(file)
-
-                                                if get_size <= 1024:  # 513410:
-                                                    file_1K_size += 1
-
-                                                if get_size > 1024:
-                                                    file_1Kplus_size += 1
-
-                                                if file_modified == compare_2_date:
-                                                    file_of_today += 1
-                                            else:
-                                                print file
-
-                                            kk += 1
-
-                                        size1kless.append(str(file_1K_size))
-                                        size1kplus.append(str(file_1Kplus_size))
-                                        todayfile.append(str(file_of_today))
-
-                                        num_files = len(file_match)
-                                        if num_files == 0:
-                                            statusfile.append('Missing')
-                                        else:
-                                            statusfile.append('Available')
-
-                                        num_files_text = str(num_files)
-                                        file_num.append(num_files_text)
-
-                                    except AttributeError:
-                                        kk = 0
-                                        file_1K_size = 0
-                                        file_1Kplus_size = 0
-                                        file_of_today = 0
-                                        web_dir = row.filename_mask
-                                        num_files_text = 'file_mask w attribute error'
-                                        size1kless.append('file_mask w attribute error')
-                                        size1kplus.append('file_mask w attribute error')
-                                        todayfile.append('file_mask w attribute error')
-                                        file_num.append('file_mask w attribute error')
-                                        statusfile.append('')
-                                        #print web_dir, '.....',  'file_mask w attribute error'
-                                else:
-                                    kk = 0
-                                    file_1K_size = 0
-                                    file_1Kplus_size = 0
-                                    file_of_today = 0
-                                    web_dir = row.filename_mask
-                                    num_files_text = 'file_mask is empty'
-                                    size1kless.append('file_mask is empty')
-                                    size1kplus.append('file_mask is empty')
-                                    todayfile.append('file_mask is empty')
-                                    file_num.append('file_mask is empty')
-                                    statusfile.append('')
-                                    #print web_dir, '.....', 'file_mask is empty'
-
-
-
-                                filereader['number_files'][row.Index] = file_num[index_i]
-                                filereader['file <= 1k'][row.Index] = size1kless[index_i]
-                                filereader['file > 1K'][row.Index] = size1kplus[index_i]
-                                filereader['file of today'][row.Index] = todayfile[index_i]
-                                filereader['Automated_status'][row.Index] = statusfile[index_i]
-
-
-
-                                print row.Index, index_i, "--->", web_dir, ' : '
-                                print '           number of files =', file_num[index_i], kk
-                                print '           file <= 1k =', size1kless[index_i] #file_1K_size
-                                print '           file > 1K =', size1kplus[index_i]#file_1Kplus_size
-                                print '           file of today =', todayfile[index_i]#file_of_today
-
-                                index_i += 1
-
-
-                            # append all sheets in one file
-                            df = df.append(filereader)
-                            df.fillna('', inplace=True)
-
-
-                mooring_header = ['ingest_csv_filename', 'platform', 'deployment#', 'uframe_route', 'filename_mask',
-                                  'number_files', 'file of today','file <= 1k', 'file > 1K',
-                                  'reference_designator', 'data_source','Automated_status','status', 'notes']
-                created_on = datein.strftime("%d-%m-%Y")
-                outputfile = main + item + '/' + item + '_' + created_on + '_rawfiles_query' + ingestion_file.split('_ingest.csv')[0] +'.csv'
-                df.to_csv(outputfile, index=False, columns=mooring_header, na_rep='NaN', encoding='utf-8')
-
-print "time elapsed: {:.2f}s".format(time.time() - start_time)
\ No newline at end of file
+csvs = ingest_catalog.find_csvs(rootdir, [ingest_key])
+for item in sorted(set(os.path.basename(os.path.dirname(x)) for x in csvs)):
+    for csv in csvs:
+        f = os.path.basename(csv)
+        if os.path.basename(os.path.dirname(csv)) == item and f.endswith(ingestion_file):
+            print f
+            filereader = ingest_catalog.read_csv(csv)
+            if 'Unnamed: 4' in filereader.columns:
+                filereader = filereader.rename(columns={'Unnamed: 4': 'status'})
+            # remove rows with empty Reference Designators
+            filereader.dropna(subset=['reference_designator'], inplace=True)
+
+            # remove rows with empty cells
+            filereader.dropna(how="all", inplace=True)
+
+            # replace NAN by empty string
+            filereader.fillna('', inplace=True)
+
+            # add the file name as a column
+            filereader['ingest_csv_filename'] = str(f)
+
+            # add to data frame --> platform name || deployment number || results
+            filereader['platform'] = filereader['ingest_csv_filename'].str.split('_').str[0].str[0:8]
+            filereader['deployment#'] = filereader['ingest_csv_filename'].str.split('_').str[1].str[3:6]
+
+            # check file path on dav
+            filereader = count_files(filereader)
+            results = filereader[['web_dir', 'number_files', 'file <= 1k', 'file > 1K', 'file of today']]
+            for i, web_dir, num_files, size1kless, size1kplus, todayfile in results.itertuples():
+                print i, "--->", web_dir, ' : '
+                print '           number of files =', num_files
+                print '           file <= 1k =', size1kless
+                print '           file > 1K =', size1kplus
+                print '           file of today =', todayfile
+
+            # append all sheets in one file
+            df = df.append(filereader.drop('web_dir', axis=1))
+            df.fillna('', inplace=True)
+
+    mooring_header = ['ingest_csv_filename', 'platform', 'deployment#', 'uframe_route', 'filename_mask',
+                      'number_files', 'file of today','file <= 1k', 'file > 1K',
+                      'reference_designator', 'data_source','Automated_status','status', 'notes']
+    created_on = datein.strftime("%d-%m-%Y")
+    outputfile = main + item + '/' + item + '_' + created_on + '_rawfiles_query' + ingestion_file.split('_ingest.csv')[0] +'.csv'
+    df.to_csv(outputfile, index=False, columns=mooring_header, na_rep='NaN', encoding='utf-8')
+
+dav.close()
+print "time elapsed: {:.2f}s".format(time.time() - start_time)
@@ -0,0 +1,198 @@
+"""
+@brief: This script keeps a local sqlite copy of the uFrame annotations and exports annotations to a csv from that copy,
+so that repeated exports do not re-download every annotation through the M2M API
+@usage:
+username: username to access the OOI API
+token: password to access the OOI API
+mirror_db: path to the sqlite mirror. Created on the first sync
+recheck: number of previously synced annotations to request again on every sync, so that edits and deletions made in
+        uFrame are picked up. The window moves through the mirror on each sync and wraps around at the end
+refdes: partially- (e.g. GS01SUMO) or fully-qualified (e.g. GS01SUMO-SBD11-06-METBKA000) reference designator, or ''
+stream, qcFlag: only export annotations with this stream or qcFlag
+begin, end: only export annotations that overlap this time range (e.g. '2016-01-01T00:00:00')
+saveDir: location to save output
+"""
+
+import csv
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+from tools import m2m_get_annotations as m2m
+
+fields = ['id', 'subsite', 'node', 'sensor', 'stream', 'method', 'parameters', 'beginDT', 'endDT', 'exclusionFlag',
+          'qcFlag', 'source', 'annotation']
+
+
+def connect_mirror(mirror_db):
+    con = sqlite3.connect(mirror_db)
+    con.execute('CREATE TABLE IF NOT EXISTS annotations (id INTEGER PRIMARY KEY, subsite TEXT, node TEXT, sensor TEXT, '
+                'stream TEXT, method TEXT, parameters TEXT, beginDT INTEGER, endDT INTEGER, exclusionFlag INTEGER, '
+                'qcFlag TEXT, source TEXT, annotation TEXT, synced REAL)')
+    con.execute('CREATE INDEX IF NOT EXISTS annotations_refdes ON annotations (subsite, node, sensor)')
+    con.execute('CREATE INDEX IF NOT EXISTS annotations_time ON annotations (beginDT, endDT)')
+    con.execute('CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value INTEGER)')
+    con.execute('CREATE TABLE IF NOT EXISTS failed (id INTEGER PRIMARY KEY)')
+    return con
+
+
+def get_state(con, key, default=0):
+    row = con.execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+    return default if row is None else row[0]
+
+
+def set_state(con, key, value):
+    con.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, value))
+
+
+def store(con, info, synced):
+    row = [info.get(k) for k in fields]
+    row[fields.index('parameters')] = json.dumps(info.get('parameters'))
+    con.execute('INSERT OR REPLACE INTO annotations ({}, synced) VALUES ({})'.format(', '.join(fields),
+                                                                                    ', '.join('?' * (len(fields) + 1))),
+                row + [synced])
+
+
+def sync(username, token, mirror_db, recheck=1000, workers=8):
+    """
+    Brings the mirror up to date. Annotations with an id above the highest id already in the mirror are downloaded,
+    and the next `recheck` annotations already in the mirror are requested again to pick up edits and deletions.
+    New ids that could not be downloaded (server errors after retries, or any other unexpected status) are kept in the
+    failed table and requested again on every sync until they return.
+    :return: tuple of (annotations added, annotations rechecked, annotations removed)
+    """
+    con = connect_mirror(mirror_db)
+    session = m2m.open_session(workers)
+    high_water = get_state(con, 'high_water', -1)
+    cursor = get_state(con, 'recheck_cursor', -1)
+
+    new_ids = m2m.get_ids(username, token, session, start_id=high_water + 1)
+    recheck_ids = [r[0] for r in con.execute('SELECT id FROM annotations WHERE id > ? AND id <= ? ORDER BY id LIMIT ?',
+                                             (cursor, high_water, recheck))]
+    if len(recheck_ids) < recheck:  # wrap around to the start of the mirror
+        recheck_ids += [r[0] for r in con.execute('SELECT id FROM annotations WHERE id <= ? ORDER BY id LIMIT ?',
+                                                  (cursor, recheck - len(recheck_ids)))]
+    rechecking = set(recheck_ids)
+    retry_ids = [r[0] for r in con.execute('SELECT id FROM failed ORDER BY id') if r[0] not in rechecking]
+
+    added = removed = 0
+    synced = time.time()
+    with con:
+        retry = set(retry_ids)
+        for x, anno in m2m.get_annotations(username, token, session, recheck_ids + retry_ids + new_ids, workers):
+            if anno.status_code == 200:
+                store(con, anno.json(), synced)
+                con.execute('DELETE FROM failed WHERE id = ?', (x,))
+                if x > high_water or x in retry:
+                    added += 1
+            elif anno.status_code == 404:  # deleted in uFrame since the last sync
+                removed += con.execute('DELETE FROM annotations WHERE id = ?', (x,)).rowcount
+                con.execute('DELETE FROM failed WHERE id = ?', (x,))
+            elif x > high_water or x in retry:  # not mirrored yet, and the high water mark moves past it
+                con.execute('INSERT OR IGNORE INTO failed (id) VALUES (?)', (x,))
+
+        if new_ids:
+            set_state(con, 'high_water', max(new_ids))
+        if recheck_ids:
+            set_state(con, 'recheck_cursor', recheck_ids[-1])
+    con.close()
+    return added, len(recheck_ids), removed
+
+
+def to_millis(date):
+    return int((datetime.strptime(date[:19], '%Y-%m-%dT%H:%M:%S') - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def query_mirror(mirror_db, refdes='', stream=None, begin=None, end=None, qcFlag=None):
+    """
+    Find annotations in the mirror
+    :param refdes: partially- or fully-qualified reference designator. Can be multiple, i.e. 'GS01SUMO, GI01SUMO-SBD11'
+    :param begin, end: only return annotations that overlap this time range
+    :return: list of annotation dictionaries, in the same form as returned by the M2M API
+    """
+    where = []
+    params = []
+    if refdes:
+        refdes_where = []
+        for rd in m2m.format_inputs(refdes):
+            # annotations on the platform or node (node or sensor NULL) apply to every instrument below them
+            parts = rd.split('-', 2)
+            rd_where = ['subsite = ?']
+            params.append(parts[0])
+            if len(parts) > 1:
+                rd_where.append('(node IS NULL OR node = ?)')
+                params.append(parts[1])
+            if len(parts) > 2:
+                rd_where.append('(sensor IS NULL OR sensor LIKE ?)')
+                params.append(parts[2] + '%')
+            refdes_where.append('(' + ' AND '.join(rd_where) + ')')
+        where.append('(' + ' OR '.join(refdes_where) + ')')
+    if stream:
+        where.append('stream = ?')
+        params.append(stream)
+    if qcFlag:
+        where.append('qcFlag = ?')
+        params.append(qcFlag)
+    if begin:
+        where.append('(endDT IS NULL OR endDT >= ?)')
+        params.append(to_millis(begin))
+    if end:
+        where.append('beginDT <= ?')
+        params.append(to_millis(end))
+
+    sql = 'SELECT {} FROM annotations'.format(', '.join(fields))
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY id'
+
+    con = connect_mirror(mirror_db)
+    annotations = []
+    for row in con.execute(sql, params):
+        info = dict(zip(fields, row))
+        info['parameters'] = json.loads(info['parameters'])
+        annotations.append(info)
+    con.close()
+    return annotations
+
+
+def get_mirrored(mirror_db, ids):
+    # look up annotations in the mirror by id. Returns {id: annotation dictionary} for the ids that are mirrored
+    con = connect_mirror(mirror_db)
+    ids = list(ids)
+    annotations = {}
+    for i in range(0, len(ids), 500):  # stay under sqlite's limit on query parameters
+        chunk = ids[i:i + 500]
+        sql = 'SELECT {} FROM annotations WHERE id IN ({})'.format(', '.join(fields), ', '.join('?' * len(chunk)))
+        for row in con.execute(sql, chunk):
+            info = dict(zip(fields, row))
+            info['parameters'] = json.loads(info['parameters'])
+            annotations[info['id']] = info
+    con.close()
+    return annotations
+
+
+def main(username, token, mirror_db, saveDir, refdes='', stream=None, begin=None, end=None, qcFlag=None,
+         recheck=1000):
+    if username and token:
+        added, rechecked, removed = sync(username, token, mirror_db, recheck)
+        print('Mirror synced: {} new, {} rechecked, {} removed'.format(added, rechecked, removed))
+
+    f = 'uframe_annotations_%s.csv' % datetime.now().strftime('%Y%m%dT%H%M%S')
+    fN = os.path.join(saveDir, f)
+    with open(fN, 'a') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(m2m.HEADER)
+        for info in query_mirror(mirror_db, refdes, stream, begin, end, qcFlag):
+            writer.writerow(m2m.format_row(info))
+    return fN
+
+
+if __name__ == '__main__':
+    username = ''
+    token = ''
+    mirror_db = '/Users/lgarzio/Documents/OOI/Annotations/uframe_annotations.db'
+    refdes = '' # 'GS01SUMO, GS01SUMO-SBD11, GS01SUMO-SBD11-06-METBKA000'
+    saveDir = '/Users/lgarzio/Documents/OOI/Annotations'
+    main(username, token, mirror_db, saveDir, refdes)
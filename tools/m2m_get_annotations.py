@@ -7,15 +7,34 @@ Modified on 3/9/2018
 @usage:
 username: username to access the OOI API
 token: password to access the OOI API
-refdes: string of partially- (e.g. GS01SUMO) or fully-qualified (e.g. GS01SUMO-SBD11-06-METBKA000) reference designators
-        or '' if requesting all annotations. Can be multiple, i.e. 'GS01SUMO, GI01SUMO-SBD11, GI01SUMO-SBD12'
+refdes: string of arrays (e.g. GS), partially- (e.g. GS01SUMO) or fully-qualified (e.g. GS01SUMO-SBD11-06-METBKA000)
+        reference designators or '' if requesting all annotations. Can be multiple, i.e. 'GS01SUMO, GI01SUMO-SBD11, GI01SUMO-SBD12'
 saveDir: location to save output
+workers: number of annotation requests to have in flight at once
+inventory_cache: local copy of the sensor inventory used to expand partial reference designators
+inventory_ttl: age in seconds after which a subsite in the inventory cache is requested again
+window_days: length of the time windows that annotation queries for a reference designator are split into
 """
 
 import requests
+from requests.packages.urllib3.exceptions import NewConnectionError
 import os
 import csv
+import json
+import sys
+import time
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+# run from anywhere: make the tools package importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools.atomic_file import atomic_write
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+INVENTORY_URL = 'https://ooinet.oceanobservatories.org/api/m2m/12576/sensor/inv/'
+INVENTORY_CACHE = os.path.join(os.path.expanduser('~'), '.ooi_sensor_inventory.json')
+HEADER = ['id','subsite','node','sensor','stream','method','parameters','beginDate','endDate',
+          'beginDT','endDT','exclusionFlag','qcFlag','source','annotation']
 
 
 def format_inputs(input_str):
@@ -28,134 +47,220 @@ def format_inputs(input_str):
     return finput
 
 
-def get_ids(username, token, session):
-    # get a list of valid annotation IDs in uFrame (for writing all annotations)
+def get_ids(username, token, session, start_id=0):
+    # get a list of valid annotation IDs in uFrame (for writing all annotations), starting at start_id. Each page starts
+    # after the last id of the previous page, so the pages have to be requested in order
     id_url = 'https://ooinet.oceanobservatories.org/api/m2m/12580/anno?max_100&select_id&start_id='
-    for x in range(100):
-        if x == 0:
-            start_id = 0
-            IDurl = id_url + str(start_id)
-            response = get_response(IDurl, username, token, session)
-            ids = sorted(response.json())
-            if len(ids) < 100:
-                loop_ids = ids
-                return loop_ids
-            else:
-                loop_ids = ids
-                start_id = ids[-1] + 1
-        else:
-            IDurl = id_url + str(start_id)
-            response = get_response(IDurl, username, token, session)
-            ids = sorted(response.json())
-            if len(ids) < 100:
-                loop_ids = loop_ids + ids
-                return loop_ids
-            else:
-                loop_ids = loop_ids + ids
-                start_id = ids[-1] + 1
+    loop_ids = []
+    while True:
+        response = get_response(id_url + str(start_id), username, token, session)
+        ids = sorted(response.json())
+        loop_ids = loop_ids + ids
+        if len(ids) < 100:
+            return loop_ids
+        start_id = ids[-1] + 1
+
+
+def get_response(url, username, token, session, retries=4, backoff=1, params=None):
+    # retries connection errors, timeouts and server-side errors, waiting backoff, 2*backoff, 4*backoff... seconds
+    for attempt in range(retries + 1):
+        try:
+            response = session.get(url=url, auth=(username, token), params=params)
+            if response.status_code not in RETRY_STATUS or attempt == retries:
+                return response
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == retries:
+                raise
+        time.sleep(backoff * 2 ** attempt)
+
+
+def not_sent(e):
+    # True if the request failed while connecting, before anything was sent to uFrame
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def open_session(workers=1):
+    # open the connection and leave it open for the session, with enough pooled connections for every worker
+    session = requests.session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    return session
 
 
-def get_response(url, username, token, session):
-    response = session.get(url=url, auth=(username, token))
-    return response
+def format_row(info):
+    beginDate = datetime.utcfromtimestamp(float(info['beginDT'])/1000).strftime('%Y-%m-%dT%H:%M:%S')
+    try:
+        endDate = datetime.utcfromtimestamp(float(info['endDT'])/1000).strftime('%Y-%m-%dT%H:%M:%S')
+    except TypeError: # if end date is blank
+        endDate = None
 
+    return [info['id'],info['subsite'],info['node'],info['sensor'],info['stream'],info['method'],
+            info['parameters'],beginDate,endDate,info['beginDT'],info['endDT'],info['exclusionFlag'],
+            info['qcFlag'],info['source'],info['annotation'].encode('utf-8')]
 
-def write_all_annotations(username, token, f, session):
-    # write annotations if no reference designator is specified
+
+def get_annotations(username, token, session, ids, workers=8):
+    # request annotations by id, with up to `workers` requests in flight. Yields (id, response) in the order of ids
     anno_url = 'https://ooinet.oceanobservatories.org/api/m2m/12580/anno/'
+
+    def get_annotation(x):
+        return x, get_response(anno_url + str(x), username, token, session)
+
+    pool = ThreadPool(workers)
+    try:
+        for x, anno in pool.imap(get_annotation, ids):
+            yield x, anno
+    finally:
+        pool.close()
+        pool.join()
+
+
+def write_all_annotations(username, token, f, session, workers=8):
+    # write annotations if no reference designator is specified. Rows are written in id order as they arrive
     loop_ids = get_ids(username, token, session)
-    print 'Writing annotations'
+    print('Writing annotations')
 
-    for x in loop_ids:
-        url = anno_url + str(x)
-        anno = get_response(url, username, token, session)
+    writer = csv.writer(f)
+    for x, anno in get_annotations(username, token, session, loop_ids, workers):
         if anno.status_code == 200: # only write info if there is a valid response
-            info = anno.json()
-            beginDate = datetime.utcfromtimestamp(float(info['beginDT'])/1000).strftime('%Y-%m-%dT%H:%M:%S')
-            try:
-                endDate = datetime.utcfromtimestamp(float(info['endDT'])/1000).strftime('%Y-%m-%dT%H:%M:%S')
-            except TypeError: # if end date is blank
-                endDate = None
-
-            writer = csv.writer(f)
-            newline = [info['id'],info['subsite'],info['node'],info['sensor'],info['stream'],info['method'],
-                       info['parameters'],beginDate,endDate,info['beginDT'],info['endDT'],info['exclusionFlag'],
-                       info['qcFlag'],info['source'],info['annotation'].encode('utf-8')]
-            writer.writerow(newline)
-
-
-def write_refdes_annotations(username, token, refdes_list, outfile, session):
-    # write annotations if any reference designator is specified
+            writer.writerow(format_row(anno.json()))
+
+
+def load_inventory(cache_file):
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return dict(fetched={}, subsites=[], tree={})
+
+
+def save_inventory(inventory, cache_file):
+    with atomic_write(cache_file) as f:
+        json.dump(inventory, f)
+
+
+def get_inventory(username, token, session, prefixes, workers=8, cache_file=INVENTORY_CACHE, ttl=86400):
+    """
+    Returns the sensor inventory tree {subsite: {node: [sensor, ...]}} for every subsite matching one of the
+    prefixes. Subsites that were fetched less than ttl seconds ago are read from the local cache, the rest are
+    requested with up to `workers` requests in flight
+    :param prefixes: list of arrays (e.g. CE), subsites (e.g. CE01ISSM) or partially-qualified reference designators
+    """
+    inventory = load_inventory(cache_file)
+    fetched = inventory['fetched']
+    now = time.time()
+
+    def stale(key):
+        return now - fetched.get(key, 0) > ttl
+
+    def get_json(url):
+        return get_response(INVENTORY_URL + url, username, token, session).json()
+
+    subsites = set(p[:8] for p in prefixes if len(p) >= 8)
+    short = [p for p in prefixes if len(p) < 8]
+    if short:  # arrays or partial subsites need the list of all subsites
+        if stale(''):
+            inventory['subsites'] = get_json('')
+            fetched[''] = now
+        subsites.update(x for x in inventory['subsites'] if x.startswith(tuple(short)))
+
+    to_fetch = sorted(x for x in subsites if stale(x))
+    if to_fetch:
+        pool = ThreadPool(workers)
+        try:
+            nodes = pool.map(lambda x: (x, get_json(x)), to_fetch)
+            pairs = [(x, n) for x, node_list in nodes for n in node_list]
+            sensors = pool.map(lambda pair: (pair, get_json('/'.join(pair))), pairs)
+        finally:
+            pool.close()
+            pool.join()
+
+        for x, node_list in nodes:
+            inventory['tree'][x] = dict((n, []) for n in node_list)
+            fetched[x] = now
+        for (x, n), sensor_list in sensors:
+            inventory['tree'][x][n] = sensor_list
+        save_inventory(inventory, cache_file)
+
+    return dict((x, inventory['tree'][x]) for x in subsites if x in inventory['tree'])
+
+
+def expand_refdes(username, token, session, frefdes, workers=8, cache_file=INVENTORY_CACHE, ttl=86400):
+    # expand arrays, subsites and nodes into a sorted list of fully-qualified reference designators
+    refdes_list = set(i for i in frefdes if len(i) == 27)
+    partial = [i for i in frefdes if len(i) != 27]
+    if partial:
+        tree = get_inventory(username, token, session, partial, workers, cache_file, ttl)
+        for x, nodes in tree.items():
+            for n, sensors in nodes.items():
+                for sen in sensors:
+                    refdes = '-'.join([x, n, sen])
+                    if refdes.startswith(tuple(partial)):
+                        refdes_list.add(refdes)
+    return sorted(refdes_list)
+
+
+def time_windows(beginDT, endDT, window_days):
+    # split the time range (milliseconds since 1970-01-01) into consecutive windows of at most window_days
+    step = int(window_days * 86400000)
+    return [(t, min(t + step, endDT)) for t in range(beginDT, endDT, step)]
+
+
+def write_refdes_annotations(username, token, refdes_list, outfile, session, workers=8, window_days=365):
+    # write annotations if any reference designator is specified. Each reference designator is queried in time windows
+    # of window_days, with up to `workers` queries in flight, and rows are written as each query completes
     anno_url = 'https://ooinet.oceanobservatories.org/api/m2m/12580/anno/find'
     today_date = int(datetime.now().strftime("%s")) * 1000 # current date
-    print 'Writing annotations'
+    windows = time_windows(1356998400000, today_date, window_days) # from 2013-01-01T00:00:00
+    print('Writing annotations')
 
-    id_list = []
-    for x in refdes_list:
+    def find_annotations(query):
+        x, (beginDT, endDT) = query
         get_params = {
-        "beginDT": 1356998400000,  # 2013-01-01T00:00:00
-        "endDT": today_date,
+        "beginDT": beginDT,
+        "endDT": endDT,
         "refdes": x
         }
-
-        response = session.get(anno_url, auth=(username, token), params=get_params)
+        response = get_response(anno_url, username, token, session, params=get_params)
         if response.status_code == 200:
-            data = response.json()
+            return response.json()
+        return []
 
+    queries = [(x, w) for x in refdes_list for w in windows]
+    writer = csv.writer(outfile)
+    id_list = set()
+    pool = ThreadPool(workers)
+    try:
+        for data in pool.imap_unordered(find_annotations, queries):
             for d in data:
-                if d['id'] not in id_list: # write annotation only if it hasn't already been written
-                    id_list.append(d['id'])
-                    beginDate = datetime.utcfromtimestamp(float(d['beginDT'])/1000).strftime('%Y-%m-%dT%H:%M:%S')
-                    try:
-                        endDate = datetime.utcfromtimestamp(float(d['endDT'])/1000).strftime('%Y-%m-%dT%H:%M:%S')
-                    except TypeError: # if end date is blank
-                        endDate = None
-                    writer = csv.writer(outfile)
-                    writer.writerow([d['id'],d['subsite'],d['node'],d['sensor'],d['stream'],d['method'],d['parameters'],
-                                     beginDate,endDate,d['beginDT'],d['endDT'],d['exclusionFlag'],d['source'],
-                                     d['annotation'].encode('utf-8')])
-
-
-def main(username, token, refdes, saveDir):
-    sensor_inv = 'https://ooinet.oceanobservatories.org/api/m2m/12576/sensor/inv/'
+                if d['id'] not in id_list: # annotations spanning several windows are returned by each of them
+                    id_list.add(d['id'])
+                    writer.writerow(format_row(d))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main(username, token, refdes, saveDir, workers=8, inventory_cache=INVENTORY_CACHE, inventory_ttl=86400,
+         window_days=365):
     f = 'uframe_annotations_%s.csv' % datetime.now().strftime('%Y%m%dT%H%M%S')
     fN = os.path.join(saveDir,f)
 
-    session = requests.session() # open the connection and leave it open for the session
+    session = open_session(workers)
     with open(fN, 'a') as outfile:
         writer = csv.writer(outfile)
-        writer.writerow(['id','subsite','node','sensor','stream','method','parameters','beginDate','endDate',
-                         'beginDT','endDT','exclusionFlag','qcFlag','source','annotation'])
+        writer.writerow(HEADER)
 
         if not refdes: # if no refdes specified, provide all annotations
-            write_all_annotations(username, token, outfile, session)
+            write_all_annotations(username, token, outfile, session, workers)
         else:
-            refdes_list = []
             frefdes = format_inputs(refdes)
-            for i in frefdes:
-                print i
-                if len(i) == 8:
-                    url = sensor_inv + i
-                    node_info = session.get(url, auth=(username, token))
-                    nodes = node_info.json()
-                    for n in nodes:
-                        url2 = url + '/' + n
-                        sensor_info = session.get(url2, auth=(username, token))
-                        sensors = sensor_info.json()
-                        for s in sensors:
-                            refdes = '-'.join([i,n,s])
-                            refdes_list.append(refdes)
-                elif len(i) == 14:
-                    url = sensor_inv + i.split('-')[0] + '/' + i.split('-')[1]
-                    sensor_info = session.get(url, auth=(username, token))
-                    sensors = sensor_info.json()
-                    for s in sensors:
-                        refdes = '-'.join([i,s])
-                        refdes_list.append(refdes)
-                elif len(i) == 27:
-                    refdes_list.append(i)
-            refdes_unique = sorted(list(set(refdes_list)))
-            write_refdes_annotations(username, token, refdes_unique, outfile, session)
+            print(', '.join(frefdes))
+            refdes_unique = expand_refdes(username, token, session, frefdes, workers, inventory_cache, inventory_ttl)
+            write_refdes_annotations(username, token, refdes_unique, outfile, session, workers, window_days)
 
 
 if __name__ == '__main__':
@@ -10,45 +10,39 @@ source: email address to associate with annotation
 username: username to access the OOI API
 token: password to access the OOI API
 url: annotation endpoint
+workers: number of annotations to push at once
+rate: maximum number of requests per second sent to the M2M API
+mirror_db: local annotation mirror (see m2m_annotation_mirror.py). If given, rows with an id that are identical to the
+            mirrored annotation are not pushed. Sync the mirror first so that it reflects the current server state
+resume: skip rows that were pushed successfully by a previous run, according to <anno_csv>_journal.csv. Every pushed row
+            is appended to the journal as soon as uFrame responds, so an interrupted push can be resumed without
+            creating duplicate annotations
+
+Every row is validated before anything is pushed. If any row is invalid, the problems are written to <anno_csv>_errors.csv
+and nothing is pushed
 """
 
 import requests
 import json
 import ast
-from datetime import datetime
-import netCDF4 as nc
+import csv
+import hashlib
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 import pandas as pd
 import numpy as np
 
-anno_csv = '/Users/lgarzio/Documents/OOI/Annotations/new_annotations.csv'
-source = 'lgarzio@marine.rutgers.edu'
-
-# production
-username = 'username'
-token = 'token'
-url = 'https://ooinet.oceanobservatories.org/api/m2m/12580/anno/'
-
-session = requests.session()
-
-# ooinet-dev-01
-# username = 'username'
-# token = 'token'
-# url = 'https://ooinet-dev-01.oceanobservatories.org/api/m2m/12580/anno/'
+from tools import m2m_annotation_mirror
+from tools import m2m_get_annotations as m2m
 
-
-def check_dates(beginDate,endDate):
-    begin_DT = datetime.strptime(beginDate,'%Y-%m-%dT%H:%M:%SZ')
-    beginDT = int(nc.date2num(begin_DT,'seconds since 1970-01-01')*1000)
-    try:
-        end_DT = datetime.strptime(endDate,'%Y-%m-%dT%H:%M:%SZ')
-        endDT = int(nc.date2num(end_DT,'seconds since 1970-01-01')*1000)
-        if endDT >= beginDT:
-            return beginDT, endDT
-        else:
-            raise Exception('beginDate (%s) is after endDate (%s)' %(begin_DT,end_DT))
-    except ValueError:
-        endDT = ''
-        return beginDT, endDT
+COLUMNS = ['id', 'subsite', 'node', 'sensor', 'stream', 'method', 'parameters', 'beginDate', 'endDate',
+           'exclusionFlag', 'qcFlag', 'source', 'annotation']
+REQUIRED = ['subsite', 'beginDate', 'annotation']
+COMPARE_FIELDS = ['subsite', 'node', 'sensor', 'stream', 'method', 'parameters', 'beginDT', 'endDT', 'exclusionFlag',
+                  'qcFlag', 'source', 'annotation']
+QC_FLAGS = ['', 'not_operational', 'not_available', 'pending_ingest', 'not_evaluated', 'suspect', 'fail', 'pass']
 
 
 def check_exclusionFlag(exclusionFlag):
@@ -59,48 +53,159 @@ def check_exclusionFlag(exclusionFlag):
     return exclusionFlag
 
 
-def check_qcFlag(qcFlag):
-    qcFlag_list = ['','not_operational','not_available','pending_ingest','not_evaluated','suspect','fail','pass']
-    if qcFlag in qcFlag_list:
-        return qcFlag
-    else:
-        raise Exception('Invalid qcFlag: %s' %qcFlag)
+def parse_parameters(parameters):
+    # the parameters column holds a python list literal, e.g. [7, 1337]. Returns None if it can't be read as a list
+    if parameters == '':
+        return []
+    try:
+        parameters = ast.literal_eval(str(parameters))
+    except (ValueError, SyntaxError):
+        return None
+    if isinstance(parameters, (list, tuple)):
+        return list(parameters)
+    return None
+
+
+def validate_annotations(df):
+    """
+    Checks every row of the annotation csv before anything is pushed: required columns and values, date format and
+    order, qcFlag vocabulary, ids and the parameters list. Dates are checked for all rows at once, and beginDate/endDate
+    are rewritten in the format uFrame expects with beginDT/endDT converted to milliseconds since 1970-01-01
+    :param df: dataframe from load_annotations
+    :return: tuple of (validated dataframe, dataframe of errors with columns row, column, error)
+    """
+    errors = []
+    error_columns = ['row', 'column', 'error']
+    missing = [c for c in COLUMNS if c not in df.columns]
+    if missing:
+        return df, pd.DataFrame([('', c, 'missing column') for c in missing], columns=error_columns)
+
+    def flag(mask, column, error):
+        for i in df.index[mask]:
+            errors.append((i + 2, column, error))  # row number in the csv, counting the header as row 1
+
+    df = df.copy()
+    for c in REQUIRED:
+        flag(df[c].astype(str).str.strip() == '', c, 'required value is empty')
+
+    begin = pd.to_datetime(df['beginDate'], errors='coerce', utc=True)
+    end = pd.to_datetime(df['endDate'], errors='coerce', utc=True)
+    flag(begin.isnull() & (df['beginDate'] != ''), 'beginDate', 'invalid date: not in the form yyyy-mm-ddTHH:MM:SS')
+    flag(end.isnull() & (df['endDate'] != ''), 'endDate', 'invalid date: not in the form yyyy-mm-ddTHH:MM:SS')
+    flag(end < begin, 'endDate', 'beginDate is after endDate')
+
+    flag(~df['qcFlag'].isin(QC_FLAGS), 'qcFlag',
+         'invalid qcFlag: must be one of ' + ', '.join(QC_FLAGS[1:]) + ' or blank')
+    flag(pd.to_numeric(df['id'], errors='coerce').isnull() & (df['id'] != ''), 'id', 'invalid id: must be an integer')
+    flag(df['parameters'].map(parse_parameters).isnull(), 'parameters',
+         'invalid parameters: must be a list, e.g. [7, 1337]')
 
+    df['beginDate'] = begin.dt.strftime('%Y-%m-%dT%H:%M:%SZ').where(begin.notnull(), '')
+    df['endDate'] = end.dt.strftime('%Y-%m-%dT%H:%M:%SZ').where(end.notnull(), '')
+    for column, dates in (('beginDT', begin), ('endDT', end)):
+        millis = pd.Series(dates.values.astype('datetime64[ms]').astype('int64'), index=df.index)
+        df[column] = millis.where(dates.notnull(), '')
 
-df = pd.read_csv(anno_csv)
-df = df.replace(np.nan, '', regex=True)
-df['beginDate'] = pd.to_datetime(df['beginDate'])
-df['beginDate'] = df['beginDate'].dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+    errors = pd.DataFrame(sorted(errors), columns=error_columns)
+    return df, errors
 
-df['endDate'] = pd.to_datetime(df['endDate'])
-df['endDate'] = df['endDate'].dt.strftime('%Y-%m-%dT%H:%M:%SZ')
-#df['uploaded'] = ''
-df['status_code'] = ''
-df['message'] = ''
-#df['annotation_id'] = ''
 
-for index, row in df.iterrows():
-    # print row
-    # print 'Reading csv row %s' #%csv_row
+class RateLimiter(object):
+    """
+    Token bucket shared by all push workers: allows `rate` requests per second on average, and bursts of up to
+    `burst` requests
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class PushJournal(object):
+    """
+    Append-only record of every pushed row: the row key, time, status code, message and annotation id. Lines are
+    flushed to disk as each push completes
+    """
+    header = ['key', 'time', 'status_code', 'message', 'id']
+
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self.lock = threading.Lock()
+        new = not os.path.isfile(journal_file)
+        self.f = open(journal_file, 'a')
+        self.writer = csv.writer(self.f)
+        if new:
+            self.writer.writerow(self.header)
+            self.f.flush()
+
+    def write(self, key, result):
+        with self.lock:
+            self.writer.writerow([key, time.strftime('%Y-%m-%dT%H:%M:%S')] + list(result))
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+    @staticmethod
+    def load(journal_file):
+        # {key: (status code, message, id)} for the rows that were pushed successfully
+        done = {}
+        if os.path.isfile(journal_file):
+            with open(journal_file, 'r') as f:
+                for line in csv.DictReader(f):
+                    if line['status_code'] in ('200', '201'):
+                        done[line['key']] = (int(line['status_code']), line['message'],
+                                             int(line['id']) if line['id'] else '')
+        return done
+
+
+def record_keys(records):
+    # identifies each record by a hash of its content, numbered if the same record appears more than once in the csv
+    keys = []
+    seen = {}
+    for d in records:
+        content = dict((k, v) for k, v in d.items() if k != 'id')
+        digest = hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+        seen[digest] = seen.get(digest, 0) + 1
+        keys.append('{}-{}'.format(digest, seen[digest]))
+    return keys
+
+
+def load_annotations(anno_csv):
+    df = pd.read_csv(anno_csv)
+    df = df.replace(np.nan, '', regex=True)
+    return df
+
+
+def build_record(row, source):
+    # build the M2M annotation record for one csv row that has been through validate_annotations
     d = {'@class': '.AnnotationRecord'}
     d['subsite'] = row['subsite']
     d['node'] = row['node']
     d['sensor'] = row['sensor']
     d['stream'] = row['stream']
     d['method'] = row['method']
-    if row['parameters'] == '':
-        d['parameters'] = []
-    else:
-        d['parameters'] = ast.literal_eval(row['parameters'])
-
-    beginDate = row['beginDate']
-    endDate = row['endDate']
-    beginDT, endDT = check_dates(beginDate,endDate)
-    d['beginDT'] = beginDT
-    d['endDT'] = endDT
+    d['parameters'] = parse_parameters(row['parameters'])
+    d['beginDT'] = int(row['beginDT'])
+    d['endDT'] = int(row['endDT']) if row['endDT'] != '' else ''
 
     d['exclusionFlag'] = check_exclusionFlag(row['exclusionFlag'])
-    d['qcFlag'] = check_qcFlag(row['qcFlag'])
+    d['qcFlag'] = row['qcFlag']
     d['annotation'] = row['annotation']
 
     if row['source']: # if source is specified in the csv, use that source
@@ -108,30 +213,166 @@ for index, row in df.iterrows():
     else: # if no source is specified, use the source defined above
         d['source'] = source
 
-    if row['id']: # if an id is specified in the csv, update the annotation
+    if row['id']: # if an id is specified in the csv, the annotation is updated
         d['id'] = int(row['id'])
-        jsond = json.dumps(d).replace('""', 'null')
-        uurl = url + str(int(row['id']))
-        r = session.put(uurl, data=jsond, auth=(username, token))
-        response = r.json()
-
-    if not row['id']: # if no id is specified in the csv, creates a new annotation
-        jsond = json.dumps(d).replace('""', 'null')
-        r = session.post(url, data=jsond, auth=(username, token))
-        response = r.json()
-
-    df.loc[row.name, 'status_code'] = r.status_code
-    df.loc[row.name, 'message'] = str(response['message'])
+    return d
+
+
+def push_record(session, url, username, token, d, limiter, retries=4, backoff=1):
+    """
+    Sends one annotation record: a PUT if the record has an id (update), otherwise a POST (new annotation).
+    A PUT can safely be repeated, so it is retried on any transient error. A POST is only retried when uFrame can't have
+    created the annotation (the connection could not be opened, or the request was rejected with 429 or 503), so a
+    retry never creates a duplicate.
+    :return: tuple of (status code, message, annotation id)
+    """
+    jsond = json.dumps(d).replace('""', 'null')
+    update = 'id' in d
+    retry_status = m2m.RETRY_STATUS if update else (429, 503)
+    for attempt in range(retries + 1):
+        limiter.wait()
+        try:
+            if update:
+                r = session.put(url + str(d['id']), data=jsond, auth=(username, token))
+            else:
+                r = session.post(url, data=jsond, auth=(username, token))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            retryable = update or m2m.not_sent(e)
+            if attempt == retries or not retryable:
+                return '', str(e), d.get('id', '')
+        else:
+            if r.status_code not in retry_status or attempt == retries:
+                try:
+                    response = r.json()
+                except ValueError:
+                    return r.status_code, r.text, d.get('id', '')
+                return r.status_code, str(response.get('message')), response.get('id', d.get('id', ''))
+        time.sleep(backoff * 2 ** attempt)
+
+
+def normalize(d):
+    # field values of an annotation record in a form that can be compared between the csv and uFrame
+    n = {}
+    for k in COMPARE_FIELDS:
+        v = d.get(k)
+        if v is None or v == '':
+            n[k] = None
+        elif k in ('beginDT', 'endDT', 'exclusionFlag'):
+            n[k] = int(v)
+        elif k == 'parameters':
+            n[k] = sorted(v) or None
+        else:
+            n[k] = v.strip() if hasattr(v, 'strip') else v
+    return n
+
+
+def classify_records(records, mirror_db):
+    """
+    Compares each record with the server state kept in the local annotation mirror (see m2m_annotation_mirror.py)
+    :return: list of 'new' (no id), 'changed' (differs from the mirror, or id not in the mirror) or 'unchanged'
+    """
+    mirrored = m2m_annotation_mirror.get_mirrored(mirror_db, [d['id'] for d in records if 'id' in d])
+    changes = []
+    for d in records:
+        if 'id' not in d:
+            changes.append('new')
+        elif d['id'] in mirrored and normalize(d) == normalize(mirrored[d['id']]):
+            changes.append('unchanged')
+        else:
+            changes.append('changed')
+    return changes
+
+
+def push_annotations(df, source, username, token, url, workers=4, rate=5, mirror_db=None, journal_file=None,
+                     resume=False):
+    """
+    Push the rows of the annotation dataframe. If a mirror_db is given, rows that match the mirrored annotation are
+    not sent. If a journal_file is given, each pushed row is appended to it, and with resume=True rows already
+    pushed successfully according to the journal are not sent again
+    :return: tuple of (list of (status code, message, id), list of new/changed/unchanged), both in row order
+    """
+    records = [build_record(row, source) for row in df.to_dict('records')]
+    keys = record_keys(records)
+    if mirror_db:
+        changes = classify_records(records, mirror_db)
+    else:
+        changes = ['changed' if 'id' in d else 'new' for d in records]
+    done = PushJournal.load(journal_file) if journal_file and resume else {}
+    to_push = [(k, d) for k, d, c in zip(keys, records, changes) if c != 'unchanged' and k not in done]
+    print('{} new, {} changed, {} unchanged annotations'.format(changes.count('new'), changes.count('changed'),
+                                                                changes.count('unchanged')))
+    if done:
+        print('{} annotations already pushed according to {}'.format(sum(k in done for k in keys), journal_file))
+
+    journal = PushJournal(journal_file) if journal_file else None
+
+    def push(item):
+        key, d = item
+        result = push_record(session, url, username, token, d, limiter)
+        if journal:
+            journal.write(key, result)
+        return result
+
+    session = m2m.open_session(workers)
+    limiter = RateLimiter(rate, burst=workers)
+
+    pool = ThreadPool(workers)
     try:
-        df.loc[row.name, 'id'] = response['id']
-    except KeyError:
-        df.loc[row.name, 'id'] = ''
-    # if r.status_code == 201:
-    #     df.loc[row.name, 'uploaded'] = True
-    #     df.loc[row.name, 'id'] = response['id']
-    #
-    # else:
-    #     df.loc[row.name, 'id'] = ''
-    #     df.loc[row.name, 'uploaded'] = False
-
-df.to_csv(anno_csv.split('.')[0] + '_run.csv', index=False)
\ No newline at end of file
+        pushed = iter(pool.map(push, to_push))
+    finally:
+        pool.close()
+        pool.join()
+        if journal:
+            journal.close()
+
+    results = []
+    for k, d, c in zip(keys, records, changes):
+        if c == 'unchanged':
+            results.append(('', 'unchanged', d['id']))
+        elif k in done:
+            results.append(done[k])
+        else:
+            results.append(next(pushed))
+    return results, changes
+
+
+def main(anno_csv, source, username, token, url, workers=4, rate=5, mirror_db=None, resume=False):
+    df = load_annotations(anno_csv)
+    df, errors = validate_annotations(df)
+    if not errors.empty: # nothing is pushed until every row is valid
+        error_csv = os.path.splitext(anno_csv)[0] + '_errors.csv'
+        errors.to_csv(error_csv, index=False)
+        print('{} problems found in {}. Nothing was pushed. See {}'.format(len(errors), anno_csv, error_csv))
+        return None
+
+    journal_file = os.path.splitext(anno_csv)[0] + '_journal.csv'
+    results, changes = push_annotations(df, source, username, token, url, workers, rate, mirror_db, journal_file,
+                                        resume)
+
+    df['status_code'] = [r[0] for r in results]
+    df['message'] = [r[1] for r in results]
+    df['id'] = [r[2] for r in results]
+    df['change'] = changes
+    df.to_csv(os.path.splitext(anno_csv)[0] + '_run.csv', index=False)
+    return df
+
+
+if __name__ == '__main__':
+    anno_csv = '/Users/lgarzio/Documents/OOI/Annotations/new_annotations.csv'
+    source = 'lgarzio@marine.rutgers.edu'
+
+    # production
+    username = 'username'
+    token = 'token'
+    url = 'https://ooinet.oceanobservatories.org/api/m2m/12580/anno/'
+
+    # ooinet-dev-01
+    # username = 'username'
+    # token = 'token'
+    # url = 'https://ooinet-dev-01.oceanobservatories.org/api/m2m/12580/anno/'
+
+    workers = 4
+    rate = 5
+    mirror_db = None # '/Users/lgarzio/Documents/OOI/Annotations/uframe_annotations.db'
+    resume = False
+    main(anno_csv, source, username, token, url, workers, rate, mirror_db, resume)
@@ -8,9 +8,17 @@
 appropriate drivers in the ingestion csvs
 """
 import os
-import glob
+import multiprocessing
+import time
+import traceback
+import numpy as np
 import pandas as pd
 from utils.parse_file import find_driver, ParticleHandler, monkey_patch_particles, StopWatch
+from tools import dav_index, ingest_catalog
+
+# driver modules already imported by this process
+_drivers = {}
+_patched = []
 
 
 def make_dir(save_dir):
@@ -20,6 +28,48 @@ def make_dir(save_dir):
         pass
 
 
+def get_driver(driver):
+    if driver not in _drivers:
+        _drivers[driver] = find_driver(driver)
+    return _drivers[driver]
+
+
+def patch_particles():
+    # patch the particle classes once per process instead of once per row
+    if not _patched:
+        monkey_patch_particles()
+        _patched.append(True)
+
+
+class CountingHandler(object):
+    # passes particles on to the particle handler, counting them on the way
+    def __init__(self, handler):
+        self.handler = handler
+        self.count = 0
+
+    def addParticleSample(self, sample_type, sample):
+        self.count += 1
+        return self.handler.addParticleSample(sample_type, sample)
+
+    def __getattr__(self, name):
+        return getattr(self.handler, name)
+
+
+def to_parquet(out, before):
+    # replace the pd-pickle files written to out since the listing `before` with parquet files. Returns the files that
+    # were left as pickles because they don't hold a dataframe
+    kept = []
+    for f in sorted(set(os.listdir(out)) - before):
+        path = os.path.join(out, f)
+        df = pd.read_pickle(path)
+        if isinstance(df, pd.DataFrame):
+            df.to_parquet(os.path.splitext(path)[0] + '.parquet')
+            os.remove(path)
+        else:
+            kept.append(f)
+    return kept
+
+
 def run(base_path, driver, files, fmt, out):
     """
     This script runs the drivers on given raw data files
@@ -27,30 +77,143 @@ def run(base_path, driver, files, fmt, out):
     :param driver: name of the driver
     :param files: a list of files
     :type files: list
-    :param fmt: 'csv', 'json', 'pd-pickle', 'xr-pickle'
+    :param fmt: 'csv', 'json', 'pd-pickle', 'xr-pickle', 'parquet'
     :param out: save directory
+    :return: tuple of (list of (file, number of particles, seconds taken to parse) for each file, list of output files
+        left as pd-pickle because they could not be written as parquet)
     """
-    monkey_patch_particles()
-    module = find_driver(driver)
-    particle_handler = ParticleHandler(output_path=out, formatter=fmt)
+    patch_particles()
+    module = get_driver(driver)
+    before = set(os.listdir(out))
+    particle_handler = CountingHandler(ParticleHandler(output_path=out,
+                                                       formatter='pd-pickle' if fmt == 'parquet' else fmt))
+    timings = []
     for file_path in files:
+        count = particle_handler.count
+        start = time.time()
         with StopWatch('Parsing file: %s took' % file_path):
             module.parse(base_path, file_path, particle_handler)
+        timings.append((file_path, particle_handler.count - count, time.time() - start))
 
     particle_handler.write()
+    kept = to_parquet(out, before) if fmt == 'parquet' else []
+    return timings, kept
+
+
+def sample_files(matches, strategy='stratified', n=5, threshold=10, seed=None, byte_budget=None):
+    """
+    Choose which of the files matched by a file mask are parsed
+    :param matches: list of (path, size, mtime)
+    :param strategy: used when more than threshold files match
+        'glob': the first n files in path order
+        'first', 'last': the n oldest or newest files by mtime
+        'largest': the n largest files
+        'stratified': n files spread evenly over the deployment, by mtime
+        'random': n files chosen at random, reproducible with seed
+    :param byte_budget: stop adding files once their total size would go over this many bytes. At least one file is
+        always parsed
+    :return: tuple of (list of (path, size, mtime) chosen, description of the sample for the status csv)
+    """
+    if len(matches) <= threshold:
+        chosen = list(matches)
+        strategy = 'all'
+    else:
+        candidates = matches
+        if strategy != 'glob':
+            # empty files are only parsed if nothing else matched
+            candidates = [x for x in matches if x[1] > 0] or matches
+        by_mtime = sorted(candidates, key=lambda x: x[2])
+        if strategy == 'glob':
+            chosen = sorted(candidates)[:n]
+        elif strategy == 'first':
+            chosen = by_mtime[:n]
+        elif strategy == 'last':
+            chosen = by_mtime[-n:]
+        elif strategy == 'largest':
+            chosen = sorted(candidates, key=lambda x: -x[1])[:n]
+        elif strategy == 'stratified':
+            idx = np.unique(np.linspace(0, len(by_mtime) - 1, min(n, len(by_mtime))).round().astype(int))
+            chosen = [by_mtime[i] for i in idx]
+        elif strategy == 'random':
+            idx = np.random.RandomState(seed).choice(len(candidates), min(n, len(candidates)), replace=False)
+            chosen = [candidates[i] for i in sorted(idx)]
+        else:
+            raise ValueError('Unknown sampling strategy: {}'.format(strategy))
+
+    if byte_budget is not None:
+        total = 0
+        kept = []
+        for x in chosen:
+            if kept and total + x[1] > byte_budget:
+                continue
+            kept.append(x)
+            total += x[1]
+        chosen = kept
+
+    description = '{} {} of {} ({} bytes)'.format(strategy, len(chosen), len(matches), sum(x[1] for x in chosen))
+    return chosen, description
 
 
-def main(ingest_file, save_dir, dav_mount, file_format='csv', splitter='/OMC/'):
+def run_row(args):
+    """
+    Parses the files of one ingestion csv row into its own output directory
+    :param args: tuple of (base_path, parser, list of (path, size, mtime) of the raw data files, file_format, out_ds)
+    :return: tuple of (number of files written to out_ds or the error raised by the driver,
+        list of (file, bytes, particles, seconds) for each file parsed, notes for the status csv)
+    """
+    base_path, parser, matches, file_format, out_ds = args
+    make_dir(out_ds)
+    sizes = dict((x[0], x[1]) for x in matches)
+    try:
+        timings, kept = run(base_path, parser, [x[0] for x in matches], file_format, out_ds)
+    except Exception:
+        return 'Driver error: {}'.format(traceback.format_exc().strip().split('\n')[-1]), [], ''
+    path, dirs, files = next(os.walk(out_ds))
+    notes = 'Not a dataframe, kept as pd-pickle: {}'.format(', '.join(kept)) if kept else ''
+    return len(files), [(f, sizes[f], particles, seconds) for f, particles, seconds in timings], notes
+
+
+def save_timings(timings, prefix):
+    """
+    Writes the parse time, particle count and size of every file parsed (<prefix>-parse_timing.csv), and the totals for
+    each driver, slowest first (<prefix>-driver_performance.csv)
+    :param timings: list of (refdeg, data_source, parser, file, bytes, particles, seconds)
+    """
+    files = pd.DataFrame(timings, columns=['refdeg', 'data_source', 'parser', 'file', 'bytes', 'particles', 'seconds'])
+    files['MB_per_s'] = files['bytes'] / 1e6 / files['seconds']
+    files.sort_values('seconds', ascending=False).to_csv(prefix + '-parse_timing.csv', index=False)
+    if files.empty:
+        return
+
+    drivers = files.groupby('parser').agg({'file': 'count', 'bytes': 'sum', 'particles': 'sum', 'seconds': 'sum'})
+    drivers = drivers.rename(columns={'file': 'files'})
+    drivers['MB_per_s'] = drivers['bytes'] / 1e6 / drivers['seconds']
+    drivers['particles_per_s'] = drivers['particles'] / drivers['seconds']
+    drivers['slowest_file'] = files.loc[files.groupby('parser')['seconds'].idxmax(), ['parser', 'file']].set_index(
+        'parser')['file']
+    drivers = drivers[['files', 'bytes', 'particles', 'seconds', 'MB_per_s', 'particles_per_s', 'slowest_file']]
+    drivers.sort_values('seconds', ascending=False).to_csv(prefix + '-driver_performance.csv')
+
+
+def main(ingest_file, save_dir, dav_mount, file_format='csv', splitter='/OMC/', processes=None, strategy='stratified',
+         sample_size=5, sample_threshold=10, seed=None, byte_budget=None):
     """
     Main method when sript is imported
     :param ingest_file: The full path and filename of the ingestion file that you want to chek
     :param save_dir: directory where you want to save your ingestion analysis data (raw data and status csv)
     :param dav_mount: Directory on local computer to OOI Raw Data dav server
-    :param file_format: Format for parsed data. Optional. 'csv' is default. Options: 'csv', 'json', 'pd-pickle', 'xr-pickle'
+    :param file_format: Format for parsed data. Optional. 'csv' is default. Options: 'csv', 'json', 'pd-pickle', 'xr-pickle', 'parquet' (needs pandas >= 0.21 with pyarrow or fastparquet, so it is not available in conda_env_osx.yml, which pins pandas 0.19.2). Output that isn't a dataframe is kept as pd-pickle and listed in the notes column of the status csv
     :param splitter: expression to split the omc server location on. This is used to transform the directory of the omc server to something we can actually can read from, the webdav server
+    :param processes: number of rows parsed at once, each in its own worker process. Default: number of cpus. 1 parses the rows one after the other in this process
+    :param strategy: how sample_size files are chosen when a file mask matches more than sample_threshold files. 'glob', 'first', 'last', 'largest', 'stratified' (default) or 'random'. See sample_files
+    :param seed: random seed for the 'random' strategy
+    :param byte_budget: maximum number of bytes parsed per file mask. Optional
     :return:
     """
     base_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..')) # base path of this toolbox
+    if file_format == 'parquet' and not hasattr(pd.DataFrame, 'to_parquet'):
+        raise ValueError('parquet output needs pandas >= 0.21 with pyarrow or fastparquet installed. The pinned '
+                         'conda_env_osx.yml environment (pandas 0.19.2) does not support it')
     make_dir(save_dir)
 
     data = []
@@ -59,7 +222,10 @@ def main(ingest_file, save_dir, dav_mount, file_format='csv', splitter='/OMC/'):
     new_dir = os.path.join(save_dir, fname)
     make_dir(new_dir)
 
-    df = pd.read_csv(ingest_file)
+    tasks = []
+    used = set()
+    dav = dav_index.DavIndex(dav_mount)
+    df = ingest_catalog.read_csv(ingest_file)
     for row in df.itertuples():
         parser = row.parser
         try:
@@ -72,25 +238,47 @@ def main(ingest_file, save_dir, dav_mount, file_format='csv', splitter='/OMC/'):
 
         if '#' in parser:
             if len(parser.strip('#')) is 0:
-                data.append((refdeg, data_source, '#', web_dir, 'Parser unavailable in ingestion csv'))
+                data.append((refdeg, data_source, '#', web_dir, 'Parser unavailable in ingestion csv', '', ''))
             else:
-                data.append((refdeg, data_source, parser, web_dir, 'Commented out in ingestion csv'))
+                data.append((refdeg, data_source, parser, web_dir, 'Commented out in ingestion csv', '', ''))
             continue
 
-        matches = glob.glob(web_dir)
-        if len(matches) > 10:
-            matches = matches[:5]
-
+        # rows that share a reference designator and data source are parsed into separate directories, so that
+        # workers never write to the same directory
         out_rd = os.path.join(new_dir, refdeg); make_dir(out_rd)
-        out_ds = os.path.join(out_rd, data_source); make_dir(out_ds)
+        out_ds = os.path.join(out_rd, data_source)
+        if out_ds in used:
+            out_ds = '{}-{}'.format(out_ds, row.Index)
+        used.add(out_ds)
+
+        matches = dav.glob(web_dir) if web_dir != 'None' else []
+        matches, sample = sample_files(matches, strategy, sample_size, sample_threshold, seed, byte_budget)
+
+        data.append((refdeg, data_source, parser, web_dir, None, sample, ''))
+        tasks.append((len(data) - 1, (base_path, parser, matches, file_format, out_ds)))
 
-        run(base_path, parser, matches, file_format, out_ds)
-        path, dirs, files = os.walk(out_ds).next()
-        file_count_new = len(files)
-        data.append((refdeg, data_source, parser, web_dir, file_count_new))
+    if processes == 1:
+        patch_particles()
+        counts = [run_row(args) for i, args in tasks]
+    else:
+        pool = multiprocessing.Pool(processes, initializer=patch_particles)
+        try:
+            counts = pool.map(run_row, [args for i, args in tasks], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    dav.close()
 
-    df = pd.DataFrame(data, columns=['refdeg', 'data_source', 'parser', 'web_dir', 'file_count'])
+    timings = []
+    for (i, args), (file_count_new, row_timings, notes) in zip(tasks, counts):
+        data[i] = data[i][:4] + (file_count_new, data[i][5], notes)
+        timings.extend(data[i][:3] + x for x in row_timings)
+
+    df = pd.DataFrame(data, columns=['refdeg', 'data_source', 'parser', 'web_dir', 'file_count', 'sample', 'notes'])
     df.to_csv(os.path.join(save_dir, fname + '-ingest_results.csv'), index=False)
+    save_timings(timings, os.path.join(save_dir, fname))
+
 
 if __name__ == '__main__':
     # change pandas display width to view longer dataframes
@@ -99,4 +287,6 @@ if __name__ == '__main__':
     file_format = 'csv'
     dav_mount = '/Volumes/dav/'
     splitter = '/OMC/'
-    main(ingest_file, save_dir, dav_mount, file_format, splitter)
\ No newline at end of file
+    processes = None
+    strategy = 'stratified'  # 'glob', 'first', 'last', 'largest', 'stratified', 'random'
+    main(ingest_file, save_dir, dav_mount, file_format, splitter, processes, strategy)